@@ -4,11 +4,70 @@ PERSON_DF = os.path.join('data', 'server', 'persons.csv')
 PERSONS_FOLDER = os.path.join('data', 'server', 'persons')
 GROUPS_DF = os.path.join('data', 'server', 'groups.csv')
 GROUPS_FOLDER = os.path.join('data', 'server', 'groups')
-PAYMENTS_DF = os.pah.join('data', 'server', 'payments.csv')
+PAYMENTS_DF = os.path.join('data', 'server', 'payments.csv')
 PAYMENTS_FOLDER = os.path.join('data', 'server', 'payments')
+LEDGER_VERSIONS_FOLDER = os.path.join('data', 'server', 'versions')
+CACHE_FOLDER = os.path.join('data', 'server', 'cache')
+SNAPSHOT_FOLDER = os.path.join('data', 'snapshots')
+EVENTS_LOG = os.path.join('data', 'server', 'events.log')
+ARCHIVE_FOLDER = os.path.join('data', 'server', 'archive')
+NAME_INDEX_FILE = os.path.join('data', 'server', 'name_index.pkl')
+
+# per-entity files (<id>.csv) are fanned out into SHARD_LEVELS levels of subdirectories,
+# each named after the next SHARD_WIDTH characters of the id (0 levels = flat folder)
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+
+# files are looked up in every layout up to SHARD_MAX_LEVELS levels, so changing SHARD_LEVELS
+# keeps the files of the previous layout readable until they are migrated (migrate-layout);
+# SHARD_WIDTH must not be changed once there are sharded files
+SHARD_MAX_LEVELS = 4
+
 REQUIRED_PERSON_ATTRS = ['name']
 REQUIRED_GROUP_ARGUMENTS = ['name']
 
+# columns of a payment table that are not group members
+PAYMENT_TABLE_COLUMNS = ['by', 'amount_minor', 'currency', 'purpose', 'location', 'split']
+
+# how a payment is split, the member columns hold integer weights whose meaning depends on it:
+# equal (1 or 0), shares (number of shares), percent (in PERCENT_SCALE-ths) or exact (minor units)
+SPLIT_MODES = ['equal', 'shares', 'percent', 'exact']
+DEFAULT_SPLIT = 'equal'
+PERCENT_SCALE = 100
+
 DEFAULT_CURRENCY ='AUD'
 DEFAULT_PURPOSE = 'General expense'
-DEFAULT_LOCATION = 'Somewhere over the rainbow'
\ No newline at end of file
+DEFAULT_LOCATION = 'Somewhere over the rainbow'
+
+# number of decimal digits of the minor unit (ISO 4217), amounts are stored as integers of it
+DEFAULT_CURRENCY_EXPONENT = 2
+CURRENCY_EXPONENTS = {'AUD': 2, 'CAD': 2, 'CHF': 2, 'EUR': 2, 'GBP': 2, 'NZD': 2, 'USD': 2,
+                      'CLP': 0, 'ISK': 0, 'JPY': 0, 'KRW': 0, 'VND': 0,
+                      'BHD': 3, 'JOD': 3, 'KWD': 3, 'OMR': 3, 'TND': 3}
+
+# out-of-core processing of payment tables: None keeps a whole table in memory, otherwise
+# tables are streamed in blocks of rows sized to use about this many bytes (an approximate
+# budget for the peak, estimated from the first rows of a table)
+CHUNK_MEMORY = None
+
+# result cache
+CACHE_MAX_ENTRIES = 1024
+CACHE_ON_DISK = False
+
+# change data capture
+EVENTS_ENABLED = True
+EVENTS_FSYNC = True
+EVENTS_INDEX_INTERVAL = 1000
+
+# name search, the saved index is rewritten on load once this many events were replayed on top of it,
+# fuzzy search walks at most NAME_INDEX_MAX_POSTINGS postings (rarest trigrams first) and scores at
+# most NAME_INDEX_MAX_CANDIDATES persons, so its cost does not grow with the number of persons
+NAME_INDEX_SAVE_INTERVAL = 1000
+NAME_INDEX_MAX_CANDIDATES = 300
+NAME_INDEX_MAX_POSTINGS = 3000
+
+# cold storage, groups without activity for ARCHIVE_IDLE_DAYS have their member list and payment
+# table packed into one compressed file, ARCHIVE_CACHE_ENTRIES decompressed files are kept in memory
+ARCHIVE_IDLE_DAYS = 90
+ARCHIVE_COMPRESSLEVEL = 9
+ARCHIVE_CACHE_ENTRIES = 64
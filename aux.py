@@ -0,0 +1,230 @@
+from decimal import Decimal, ROUND_HALF_EVEN, InvalidOperation
+import numpy as np
+from paytrack.DEFAULTS import *
+
+
+class Money:
+    """
+    Conversion between amounts in a currency and integer minor units (e.g. cents)
+    """
+
+    @staticmethod
+    def exponent(currency):
+        """
+        Number of decimal digits of the minor unit of a currency
+        :param currency: string representing the currency
+        :return: exponent
+        """
+
+        return CURRENCY_EXPONENTS.get(currency, DEFAULT_CURRENCY_EXPONENT)
+
+    @staticmethod
+    def to_minor(amount, currency, strict=False):
+        """
+        Converts an amount (float, string or Decimal) into integer minor units
+        :param amount: amount in the currency
+        :param currency: string representing the currency
+        :param strict: if True, raise instead of rounding amounts finer than the minor unit
+        :return: amount in minor units
+        """
+
+        # go through the shortest text representation, so that 0.1 becomes exactly 10 cents
+        try:
+            value = Decimal(amount if isinstance(amount, (str, Decimal)) else repr(amount))
+        except InvalidOperation:
+            raise ValueError('Invalid amount: \'{}\''.format(amount))
+
+        scaled = value.scaleb(Money.exponent(currency))
+        minor = scaled.to_integral_value(rounding=ROUND_HALF_EVEN)
+
+        if strict and minor != scaled:
+            raise ValueError('Amount {} is finer than the minor unit of {}'.format(amount, currency))
+
+        return int(minor)
+
+    @staticmethod
+    def from_minor(minor, currency):
+        """
+        Converts integer minor units into a float amount
+        :param minor: amount in minor units
+        :param currency: string representing the currency
+        :return: amount in the currency
+        """
+
+        return float(Decimal(int(minor)).scaleb(-Money.exponent(currency)))
+
+    @staticmethod
+    def to_string(minor, currency):
+        """
+        Converts integer minor units into an exact decimal string (e.g. '12.50')
+        :param minor: amount in minor units
+        :param currency: string representing the currency
+        :return: amount in the currency as a string
+        """
+
+        return str(Decimal(int(minor)).scaleb(-Money.exponent(currency)))
+
+    @staticmethod
+    def to_minor_array(amounts, currencies, strict=False):
+        """
+        Converts a sequence of amounts into an int64 array of minor units
+        :param amounts: sequence of amounts
+        :param currencies: sequence of currencies (same length)
+        :param strict: if True, raise instead of rounding amounts finer than the minor unit
+        :return: numpy array of minor units
+        """
+
+        return np.array([Money.to_minor(a, c, strict=strict) for a, c in zip(amounts, currencies)],
+                        dtype=np.int64)
+
+    @staticmethod
+    def from_minor_array(minors, currencies):
+        """
+        Converts an array of minor units into float amounts
+        :param minors: sequence of minor units
+        :param currencies: sequence of currencies (same length)
+        :return: numpy array of amounts
+        """
+
+        scale = np.array([10. ** Money.exponent(c) for c in currencies])
+        return np.asarray(minors, dtype=np.int64) / scale
+
+    @staticmethod
+    def split(amounts, weights):
+        """
+        Splits amounts among participants in proportion to integer weights, exactly.
+
+        Every participant gets the floor of their share, the remaining minor units go
+        one each to the participants with the largest fractional parts (ties go to the
+        first column), so every row sums to its amount and the result is deterministic.
+        :param amounts: int64 array with one amount (minor units) per payment
+        :param weights: non-negative integer array (payments x participants)
+        :return: int64 array (payments x participants) of the owed minor units
+        """
+
+        amounts = np.asarray(amounts, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.int64)
+
+        if weights.size == 0:
+            return np.zeros(weights.shape, dtype=np.int64)
+
+        totals = weights.sum(axis=1)
+        if (totals == 0).any():
+            raise ValueError('Payment without participants')
+
+        # floor of every share and the fractional part as an integer numerator
+        numerators = amounts[:, None] * weights
+        shares = numerators // totals[:, None]
+        fractions = numerators - shares * totals[:, None]
+
+        # number of minor units that still have to be distributed per payment
+        remainders = amounts - shares.sum(axis=1)
+
+        # rank participants by fractional part, stable so that ties keep column order
+        order = np.argsort(-fractions, axis=1, kind='stable')
+        ranks = np.empty_like(order)
+        np.put_along_axis(ranks, order, np.arange(weights.shape[1])[None, :].repeat(len(order), axis=0), axis=1)
+
+        return shares + ((ranks < remainders[:, None]) & (weights > 0))
+
+
+class Split:
+    """
+    Converts how a payment is split into integer weights per participant and back, and
+    computes what every participant owes for a whole ledger at once
+    """
+
+    @staticmethod
+    def _to_percent_units(percent):
+        """
+        Converts a percentage into an integer number of 1/PERCENT_SCALE percent
+        :param percent: percentage (float, string or Decimal)
+        :return: integer weight
+        """
+
+        value = Decimal(percent if isinstance(percent, (str, Decimal)) else repr(percent)) * PERCENT_SCALE
+
+        if value != value.to_integral_value():
+            raise ValueError('Percentage {} is finer than 1/{} percent'.format(percent, PERCENT_SCALE))
+
+        return int(value)
+
+    @staticmethod
+    def to_weights(split, amount_minor, currency, weights):
+        """
+        Converts the weights of a payment into their stored integer form and validates them
+        :param split: one of SPLIT_MODES
+        :param amount_minor: amount of the payment in minor units
+        :param currency: string representing the currency
+        :param weights: dictionary participant id -> weight (1, shares, percent or exact amount)
+        :return: dictionary participant id -> integer weight
+        """
+
+        if split not in SPLIT_MODES:
+            raise ValueError('Unknown split: \'{}\''.format(split))
+
+        if split == 'equal':
+            stored = {k: int(bool(v)) for k, v in weights.items()}
+        elif split == 'shares':
+            stored = {k: int(v) for k, v in weights.items()}
+            if any(stored[k] != v for k, v in weights.items()):
+                raise ValueError('Shares have to be whole numbers')
+        elif split == 'percent':
+            stored = {k: Split._to_percent_units(v) for k, v in weights.items()}
+            if sum(stored.values()) != 100 * PERCENT_SCALE:
+                raise ValueError('Percentages add up to {}, not 100'.format(sum(stored.values()) / PERCENT_SCALE))
+        else:
+            stored = {k: Money.to_minor(v, currency, strict=True) for k, v in weights.items()}
+            if sum(stored.values()) != amount_minor:
+                raise ValueError('Exact amounts add up to {}, not {}'.format(
+                    Money.from_minor(sum(stored.values()), currency), Money.from_minor(amount_minor, currency)))
+
+        # a refund (negative amount) is split exactly into negative amounts
+        if split == 'exact':
+            if any(v * amount_minor < 0 for v in stored.values()):
+                raise ValueError('Exact amounts need the sign of the payment')
+        elif any(v < 0 for v in stored.values()):
+            raise ValueError('Weights cannot be negative')
+        if split != 'exact' and not any(stored.values()):
+            raise ValueError('Payment without participants')
+
+        return stored
+
+    @staticmethod
+    def from_weights(split, currency, stored):
+        """
+        Converts stored integer weights back into the weights of a payment
+        :param split: one of SPLIT_MODES
+        :param currency: string representing the currency
+        :param stored: dictionary participant id -> integer weight
+        :return: dictionary participant id -> weight
+        """
+
+        if split == 'percent':
+            return {k: v / PERCENT_SCALE for k, v in stored.items()}
+        if split == 'exact':
+            return {k: Money.from_minor(v, currency) for k, v in stored.items()}
+
+        return {k: int(v) for k, v in stored.items()}
+
+    @staticmethod
+    def owed(amounts, splits, weights):
+        """
+        Computes what every participant owes for every payment of a ledger
+        :param amounts: int64 array with one amount (minor units) per payment
+        :param splits: array with the split mode of every payment
+        :param weights: integer array (payments x participants) of stored weights
+        :return: int64 array (payments x participants) of the owed minor units
+        """
+
+        amounts = np.asarray(amounts, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.int64)
+        exact = np.asarray(splits) == 'exact'
+
+        # exact amounts are owed as they are, everything else is proportional to the weights
+        owed = weights.copy()
+        proportional = ~exact
+        if proportional.any():
+            owed[proportional] = Money.split(amounts[proportional], weights[proportional])
+
+        return owed
@@ -0,0 +1,337 @@
+import os
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+from paytrack.io import LayoutIO
+from paytrack.DEFAULTS import *
+
+
+@contextmanager
+def data_tree():
+    """
+    Context manager that runs its body in a fresh temporary directory containing an
+    empty data/server tree, and changes back afterwards
+    :return: path of the temporary directory
+    """
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as root:
+        os.chdir(root)
+        try:
+            for folder in [PERSONS_FOLDER, GROUPS_FOLDER, PAYMENTS_FOLDER]:
+                os.makedirs(folder, exist_ok=True)
+            yield root
+        finally:
+            os.chdir(cwd)
+
+
+def _snapshot_tree():
+    """
+    Reads the current data/server tree with the uuids replaced by their position, so that
+    two trees created with different ids can be compared
+    :return: dictionary with the persons, groups and memberships
+    """
+
+    persons = pd.read_csv(PERSON_DF)
+    groups = pd.read_csv(GROUPS_DF)
+    alias = {id: i for i, id in enumerate(persons.loc[:, 'id'])}
+    alias.update({id: 'g{}'.format(i) for i, id in enumerate(groups.loc[:, 'id'])})
+
+    members = {}
+    for g in groups.loc[:, 'id']:
+        members[alias[g]] = [alias[m] for m in LayoutIO.read_csv(GROUPS_FOLDER, g).loc[:, 'members']]
+
+    memberships = {}
+    for p in persons.loc[:, 'id']:
+        memberships[alias[p]] = [alias[g] for g in LayoutIO.read_csv(PERSONS_FOLDER, p).loc[:, 'groups']]
+
+    return {'persons': list(persons.loc[:, 'name']),
+            'groups': list(groups.loc[:, 'name']),
+            'members': members,
+            'memberships': memberships}
+
+
+def bench_group_creation(n_people=200):
+    """
+    Compares creating a group with n new members one by one and in one batch
+    :param n_people: number of members
+    :return: dictionary with the timings (seconds), the speedup and whether both trees are equal
+    """
+
+    from paytrack.group import Person, Group
+
+    names = ['Person {}'.format(i) for i in range(n_people)]
+
+    # one by one
+    with data_tree():
+        start = time.perf_counter()
+        people = [Person(name=name) for name in names]
+        Group(people=people, name='Event')
+        one_by_one = time.perf_counter() - start
+        expected = _snapshot_tree()
+
+    # batched
+    with data_tree():
+        start = time.perf_counter()
+        Group.create_with_members([{'name': name} for name in names], name='Event')
+        batched = time.perf_counter() - start
+        result = _snapshot_tree()
+
+    return {'people': n_people,
+            'one_by_one': one_by_one,
+            'batched': batched,
+            'speedup': one_by_one / batched,
+            'equal': expected == result}
+
+
+def _write_random_ledger(group_id, n_rows, n_members, seed=0):
+    """
+    Writes a random payment table with equal, shares and exact splits
+    :param group_id: id of the group
+    :param n_rows: number of payments
+    :param n_members: number of members
+    :param seed: random seed
+    :return: list of member ids
+    """
+
+    rng = np.random.default_rng(seed)
+    members = ['m{}'.format(i) for i in range(n_members)]
+
+    table = pd.DataFrame({'by': rng.choice(members, n_rows),
+                          'amount_minor': rng.integers(1, 100000, n_rows),
+                          'currency': rng.choice(['AUD', 'EUR', 'JPY'], n_rows),
+                          'purpose': DEFAULT_PURPOSE,
+                          'location': DEFAULT_LOCATION,
+                          'split': rng.choice(['equal', 'shares'], n_rows)})
+
+    weights = rng.integers(0, 3, (n_rows, n_members))
+    weights[:, 0] += weights.sum(axis=1) == 0
+    for i, m in enumerate(members):
+        table.loc[:, m] = weights[:, i]
+
+    table.to_csv(LayoutIO.write_path(PAYMENTS_FOLDER, group_id), index=False)
+    return members
+
+
+def bench_chunked_balances(n_rows=200000, n_members=50, chunksize=10000):
+    """
+    Compares peak memory and time of computing balances in memory and streamed in blocks
+    :param n_rows: number of payments in the ledger
+    :param n_members: number of members
+    :param chunksize: rows per block
+    :return: dictionary with the timings (seconds), peak memory (MB) and whether both results are equal
+    """
+
+    from paytrack.payments import Ledger
+    from paytrack.io import GroupsIO
+
+    res = {'rows': n_rows, 'chunksize': chunksize}
+
+    with data_tree():
+        _write_random_ledger('ledger', n_rows, n_members)
+
+        results = {}
+        for mode, size in [('in_memory', None), ('chunked', chunksize)]:
+            tracemalloc.start()
+            start = time.perf_counter()
+            results[mode] = Ledger.compute_balances_chunked(GroupsIO.iter_payment_table('ledger', size))
+            res[mode] = time.perf_counter() - start
+            res[mode + '_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+
+    res['equal'] = results['in_memory'].equals(results['chunked'])
+    return res
+
+
+def bench_name_search(n_persons=100000, n_queries=200, k=10, seed=0):
+    """
+    Compares typeahead queries on the name index with a naive scan of the persons list
+    :param n_persons: number of persons
+    :param n_queries: number of queries
+    :param k: results per query
+    :param seed: random seed
+    :return: dictionary with the timings (milliseconds per query), the speedup and whether the
+    prefix search finds the same persons as the scan
+    """
+
+    import re
+    import random
+    from paytrack.search import NameIndex, normalize
+
+    rng = random.Random(seed)
+    syllables = ['an', 'be', 'chi', 'da', 'el', 'fo', 'gu', 'ha', 'ja', 'ko', 'li', 'ma', 'né', 'ol',
+                 'pe', 'ri', 'sa', 'to', 'ul', 'vi', 'wo', 'ye', 'zé']
+
+    def word():
+        return ''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))).capitalize()
+
+    names = ['{} {}'.format(word(), word()) for _ in range(n_persons)]
+    queries = [rng.choice(rng.choice(names).split(' '))[:rng.randint(2, 6)] for _ in range(n_queries)]
+
+    res = {'persons': n_persons, 'queries': n_queries}
+
+    with data_tree():
+        pd.DataFrame({'name': names, 'id': ['p{}'.format(i) for i in range(n_persons)]}).to_csv(PERSON_DF, index=False)
+
+        start = time.perf_counter()
+        index = NameIndex.build()
+        res['build_s'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        found = [index.prefix(q, k) for q in queries]
+        res['index_ms'] = (time.perf_counter() - start) / n_queries * 1000
+
+        # typos: a letter of the query replaced
+        typos = [q[:-1] + rng.choice('aeiou') for q in queries]
+        start = time.perf_counter()
+        for q in typos:
+            index.fuzzy(q, k)
+        res['fuzzy_ms'] = (time.perf_counter() - start) / n_queries * 1000
+
+        # naive: read the persons list and scan it on every keystroke
+        start = time.perf_counter()
+        scanned = []
+        for q in queries:
+            p_df = pd.read_csv(PERSON_DF)
+            pattern = r'(?:^|\s)' + re.escape(normalize(q))
+            scanned.append(set(p_df.loc[p_df.loc[:, 'name'].map(normalize).str.contains(pattern), 'id']))
+        res['naive_ms'] = (time.perf_counter() - start) / n_queries * 1000
+
+    res['speedup'] = res['naive_ms'] / res['index_ms']
+
+    # every index hit must be a scan hit, and the index returns k hits whenever the scan has them
+    res['equal'] = all({id for id, _ in f} <= s and len(f) >= min(k, len(s)) for f, s in zip(found, scanned))
+    return res
+
+
+def bench_membership(n_members=1000, n_payments=200, seed=0):
+    """
+    Measures the identity map and the set / index based membership tests on a large group:
+    loading the group while its members are in use, serializing payments of half of the
+    members and reading them back, compared with list scans over the members
+    :param n_members: number of members
+    :param n_payments: number of payments
+    :param seed: random seed
+    :return: dictionary with the timings (seconds) and whether the results are equal
+    """
+
+    import random
+    from paytrack.group import Session, Group, Payment
+    from paytrack.io import GroupsIO
+    from paytrack.aux import Split
+
+    rng = random.Random(seed)
+    res = {'members': n_members, 'payments': n_payments}
+
+    with data_tree():
+        group_id = Group.create_with_members([{'name': 'Person {}'.format(i)} for i in range(n_members)],
+                                             name='Event').id
+
+        with Session():
+            # every member is read from disk
+            start = time.perf_counter()
+            group = Group.from_id(group_id)
+            res['load_cold'] = time.perf_counter() - start
+
+            # the members are still in use, so they come from the identity map of the session
+            start = time.perf_counter()
+            again = Group.from_id(group_id)
+            res['load_warm'] = time.perf_counter() - start
+            res['same_objects'] = all(a is b for a, b in zip(group.people, again.people))
+
+        payments = [Payment(group.people[0], group, rng.randint(1, 10000) / 100,
+                            people=rng.sample(group.people, n_members // 2))
+                    for _ in range(n_payments)]
+
+        # serialization with a list scan over the participants for every member
+        start = time.perf_counter()
+        naive = []
+        for payment in payments:
+            dct = {'by': [payment.by.id], 'amount_minor': [payment.amount_minor], 'currency': [payment.currency],
+                   'purpose': [payment.purpose], 'location': [payment.location], 'split': [payment.split]}
+            for p in group.people:
+                dct.update({p.id: [1 if p in payment.people else 0]})
+            naive.append(pd.DataFrame(dct))
+        res['to_df_list_scan'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        frames = [payment.to_df() for payment in payments]
+        res['to_df'] = time.perf_counter() - start
+
+        table = pd.concat(frames, ignore_index=True)
+        res['to_df_equal'] = table.equals(pd.concat(naive, ignore_index=True))
+        table.to_csv(LayoutIO.write_path(PAYMENTS_FOLDER, group_id), index=False)
+
+        # reading the payments back, looking at every member of every row
+        start = time.perf_counter()
+        members = [c for c in table.columns if c not in PAYMENT_TABLE_COLUMNS]
+        scanned = []
+        for _, row in GroupsIO._load_payment_table(group_id).iterrows():
+            stored = {p: row[p] for p in members if row[p]}
+            scanned.append(Split.from_weights(row['split'], row['currency'], stored))
+        res['read_row_scan'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        read = GroupsIO.get_payments(group_id)
+        res['read'] = time.perf_counter() - start
+        res['read_equal'] = [d['weights'] for d in read] == scanned
+
+    return res
+
+
+def bench_archive(n_groups=50, n_rows=2000, n_members=20):
+    """
+    Measures the disk space saved by archiving groups and the latency of reading them from
+    cold storage
+    :param n_groups: number of groups
+    :param n_rows: payments per group
+    :param n_members: members per group
+    :return: dictionary with the sizes (bytes), the latencies (milliseconds per group) and
+    whether cold reads return the same payments
+    """
+
+    from paytrack.io import GroupsIO, ArchiveIO
+    from paytrack.group import Group, Payment
+
+    res = {'groups': n_groups, 'rows': n_rows}
+    group_ids = ['group{}'.format(i) for i in range(n_groups)]
+
+    def read_all():
+        start = time.perf_counter()
+        payments = [GroupsIO.get_payments(g) for g in group_ids]
+        for g in group_ids:
+            GroupsIO.get_group(g)
+        return (time.perf_counter() - start) / n_groups * 1000, payments
+
+    with data_tree():
+        pd.DataFrame({'name': group_ids, 'id': group_ids}).to_csv(GROUPS_DF, index=False)
+        pd.DataFrame({'name': ['m{}'.format(i) for i in range(n_members)],
+                      'id': ['m{}'.format(i) for i in range(n_members)]}).to_csv(PERSON_DF, index=False)
+        for i, g in enumerate(group_ids):
+            members = _write_random_ledger(g, n_rows, n_members, seed=i)
+            pd.DataFrame({'members': members}).to_csv(LayoutIO.write_path(GROUPS_FOLDER, g), index=False)
+
+        res['hot_read_ms'], hot = read_all()
+
+        report = ArchiveIO.archive_idle(idle_days=0)
+        res['hot_bytes'] = report['bytes']
+        res['archived_bytes'] = report['archived_bytes']
+        res['saved'] = 1 - report['archived_bytes'] / report['bytes']
+
+        # the first read decompresses, later ones are served from the cache
+        res['cold_read_ms'], cold = read_all()
+        res['cached_read_ms'], _ = read_all()
+        res['equal'] = hot == cold
+
+        # a new payment promotes the group back to hot storage
+        start = time.perf_counter()
+        for g in group_ids:
+            group = Group.from_id(g)
+            GroupsIO.add_payment(g, Payment(group.people[0], group, 1))
+        res['promote_ms'] = (time.perf_counter() - start) / n_groups * 1000
+        res['still_archived'] = sum(ArchiveIO.is_archived(g) for g in group_ids)
+
+    return res
@@ -0,0 +1,178 @@
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+from paytrack.DEFAULTS import *
+
+
+class ResultCache:
+    """
+    Memoizes computed results (balances, settlements, ...) of a group.
+
+    Entries are keyed by (kind, group id, ledger version). Whenever the ledger of a
+    group changes its version is bumped, so outdated entries are simply never hit
+    again and age out of the LRU order.
+    """
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, on_disk=CACHE_ON_DISK, folder=CACHE_FOLDER):
+        """
+        Initiates a result cache
+        :param max_entries: maximum number of entries held in memory
+        :param on_disk: if True, results are also kept as pickles in folder and survive restarts
+        :param folder: folder of the on-disk tier
+        """
+
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+        self._on_disk = on_disk
+        self._folder = folder
+
+        # counters
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        """Number of entries in memory"""
+        return len(self._entries)
+
+    def _group_folder(self, group_id):
+        """
+        Folder of the on-disk entries of a group, sharded like the per-entity files so that no
+        folder holds the entries of all groups
+        :param group_id: uuid of the group
+        :return: folder name
+        """
+
+        from paytrack.io import LayoutIO
+
+        return LayoutIO._path(self._folder, group_id, SHARD_LEVELS, suffix='')
+
+    def _file_name(self, key):
+        """
+        File name of an entry in the on-disk tier
+        :param key: (kind, group id, version) tuple
+        :return: file name
+        """
+
+        kind, group_id, version = key
+        return os.path.join(self._group_folder(group_id), '{}_{}.pkl'.format(kind, version))
+
+    def _load_from_disk(self, key):
+        """
+        Loads an entry from the on-disk tier
+        :param key: (kind, group id, version) tuple
+        :return: (found, value) tuple
+        """
+
+        try:
+            with open(self._file_name(key), 'rb') as f:
+                return True, pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return False, None
+
+    def _save_to_disk(self, key, value):
+        """
+        Saves an entry to the on-disk tier and removes older versions of it
+        :param key: (kind, group id, version) tuple
+        :param value: result to store
+        :return: None
+        """
+
+        f_name = self._file_name(key)
+        folder = os.path.dirname(f_name)
+        os.makedirs(folder, exist_ok=True)
+
+        # write to a temporary file of this writer first, so that readers never see half an entry
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, f_name)
+
+        # outdated versions of the same result will never be requested again, only the folder
+        # of this group has to be looked at
+        for old in os.listdir(folder):
+            if old.endswith('.pkl') and old.rsplit('_', 1)[0] == key[0] and old != os.path.basename(f_name):
+                try:
+                    os.remove(os.path.join(folder, old))
+                except FileNotFoundError:
+                    pass
+
+    def _put(self, key, value):
+        """
+        Puts an entry into memory and evicts the least recently used ones
+        :param key: (kind, group id, version) tuple
+        :param value: result to store
+        :return: None
+        """
+
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_compute(self, kind, group_id, version, compute):
+        """
+        Returns a cached result or computes and caches it
+        :param kind: name of the result (e.g. 'balances')
+        :param group_id: uuid of the group
+        :param version: ledger version of the group
+        :param compute: function without arguments that computes the result
+        :return: result
+        """
+
+        key = (kind, group_id, version)
+
+        # memory tier
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+        # disk tier
+        if self._on_disk:
+            found, value = self._load_from_disk(key)
+            if found:
+                self.disk_hits += 1
+                self._put(key, value)
+                return value
+
+        # compute
+        self.misses += 1
+        value = compute()
+        self._put(key, value)
+        if self._on_disk:
+            self._save_to_disk(key, value)
+
+        return value
+
+    def invalidate(self, group_id):
+        """
+        Drops all in-memory entries of a group
+        :param group_id: uuid of the group
+        :return: None
+        """
+
+        for key in [k for k in self._entries if k[1] == group_id]:
+            del self._entries[key]
+
+    def clear(self):
+        """
+        Drops all in-memory entries and resets the counters
+        :return: None
+        """
+
+        self._entries.clear()
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+
+    @property
+    def stats(self):
+        """Hit/miss/eviction counters"""
+        return {'entries': len(self._entries),
+                'max_entries': self._max_entries,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
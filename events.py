@@ -0,0 +1,304 @@
+import os
+import json
+import time
+import fcntl
+import bisect
+from collections import namedtuple
+from paytrack.DEFAULTS import *
+
+# event types, one per storage mutation
+PERSON_ADDED = 'person_added'
+PERSON_UPDATED = 'person_updated'
+PERSON_REMOVED = 'person_removed'
+PERSON_GROUPS_UPDATED = 'person_groups_updated'
+GROUP_ADDED = 'group_added'
+GROUP_UPDATED = 'group_updated'
+GROUP_REMOVED = 'group_removed'
+GROUP_MEMBERS_UPDATED = 'group_members_updated'
+GROUP_ARCHIVED = 'group_archived'
+GROUP_RESTORED = 'group_restored'
+LEDGER_MEMBER_ADDED = 'ledger_member_added'
+PAYMENT_ADDED = 'payment_added'
+PAYMENT_TABLE_MIGRATED = 'payment_table_migrated'
+
+EVENT_TYPES = [PERSON_ADDED, PERSON_UPDATED, PERSON_REMOVED, PERSON_GROUPS_UPDATED,
+               GROUP_ADDED, GROUP_UPDATED, GROUP_REMOVED, GROUP_MEMBERS_UPDATED, GROUP_ARCHIVED, GROUP_RESTORED,
+               LEDGER_MEMBER_ADDED, PAYMENT_ADDED, PAYMENT_TABLE_MIGRATED]
+
+Event = namedtuple('Event', ['seq', 'type', 'entity_id', 'payload', 'time'])
+
+
+def _json_default(o):
+    """Makes numpy scalars json serializable"""
+    return o.item()
+
+
+class EventLog:
+    """
+    Append-only, durable log of storage events (one json line per event). Sequence numbers
+    are assigned under an exclusive file lock, so they increase monotonically across all
+    writer processes. A sparse index of (sequence number, byte position) pairs lets readers
+    start from any offset without scanning the whole log.
+
+    Events are emitted after the mutation is saved (changes to a ledger while still holding its
+    lock, see GroupsIO._ledger_lock). This is not a write-ahead log: a process that crashes
+    between saving and emitting loses the event, consumers have to be able to resync from the
+    data itself.
+    """
+    def __init__(self, f_name=EVENTS_LOG, fsync=EVENTS_FSYNC, index_interval=EVENTS_INDEX_INTERVAL):
+        """
+        Initiates an event log
+        :param f_name: log file
+        :param fsync: if True, every event is flushed to disk before the mutation returns
+        :param index_interval: every index_interval-th event is added to the index
+        """
+
+        self._f_name = f_name
+        self._fsync = fsync
+        self._index_interval = index_interval
+        self._subscribers = []
+
+    @property
+    def f_name(self):
+        """Log file"""
+        return self._f_name
+
+    @staticmethod
+    def _repair(f):
+        """
+        Cuts off an incomplete last line, left behind by a writer that crashed in the middle of
+        an event (readers never consumed it, they only read complete lines)
+        :param f: log file opened in binary mode, under the exclusive lock
+        :return: None
+        """
+
+        size = f.seek(0, os.SEEK_END)
+        block = 4096
+        end = size
+
+        while end > 0:
+            start = max(0, end - block)
+            f.seek(start)
+            data = f.read(end - start)
+
+            if end == size and data.endswith(b'\n'):
+                return
+
+            newline = data.rfind(b'\n')
+            if newline >= 0:
+                f.truncate(start + newline + 1)
+                return
+
+            end = start
+
+        f.truncate(0)
+
+    @staticmethod
+    def _last_seq(f):
+        """
+        Reads the sequence number of the last event
+        :param f: log file opened in binary mode, ending with a complete line
+        :return: sequence number (0 if the log is empty)
+        """
+
+        size = f.seek(0, os.SEEK_END)
+        block = 4096
+
+        while True:
+            start = max(0, size - block)
+            f.seek(start)
+            lines = f.read(size - start).splitlines()
+
+            # the first line may be cut off, unless we read from the beginning
+            if len(lines) > 1 or start == 0:
+                return json.loads(lines[-1])['seq'] if lines else 0
+
+            block *= 2
+
+    def emit(self, type, entity_id, payload=None):
+        """
+        Appends an event to the log and notifies in-process subscribers
+        :param type: one of EVENT_TYPES
+        :param entity_id: uuid of the person or group the event is about
+        :param payload: json serializable dictionary with the details
+        :return: Event object
+        """
+
+        events = self.emit_many([(type, entity_id, payload)])
+        return events[0] if events else None
+
+    def emit_many(self, items):
+        """
+        Appends several events to the log at once: one lock, one write and one fsync for all
+        of them, for mutations that save a whole batch
+        :param items: list of (type, entity_id, payload) tuples, see emit
+        :return: list of Event objects
+        """
+
+        if not EVENTS_ENABLED or not items:
+            return []
+
+        for type, _, _ in items:
+            if type not in EVENT_TYPES:
+                raise ValueError('Unknown event type: \'{}\''.format(type))
+
+        os.makedirs(os.path.dirname(self._f_name) or '.', exist_ok=True)
+
+        with open(self._f_name, 'a+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self._repair(f)
+                seq = self._last_seq(f)
+                now = time.time()
+
+                events = [Event(seq=seq + i + 1,
+                                type=type,
+                                entity_id=entity_id,
+                                payload=payload if payload is not None else {},
+                                time=now) for i, (type, entity_id, payload) in enumerate(items)]
+                lines = [json.dumps(event._asdict(), default=_json_default).encode('utf-8') + b'\n'
+                         for event in events]
+
+                position = f.seek(0, os.SEEK_END)
+                f.write(b''.join(lines))
+                f.flush()
+                if self._fsync:
+                    os.fsync(f.fileno())
+
+                # sparse index
+                entries = []
+                for event, line in zip(events, lines):
+                    if (event.seq - 1) % self._index_interval == 0:
+                        entries.append('{} {}\n'.format(event.seq, position))
+                    position += len(line)
+                if entries:
+                    with open(self._f_name + '.idx', 'a') as idx:
+                        idx.write(''.join(entries))
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+        for event in events:
+            for callback in list(self._subscribers):
+                callback(event)
+
+        return events
+
+    def subscribe(self, callback):
+        """
+        Registers a function that is called with every event emitted by this process (ledger
+        events are emitted while the ledger lock is held, so it must not write to that group)
+        :param callback: function taking an Event
+        :return: None
+        """
+
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """
+        Removes a function registered with subscribe
+        :param callback: function
+        :return: None
+        """
+
+        self._subscribers.remove(callback)
+
+    def _position(self, seq):
+        """
+        Finds a byte position at or before the event with a given sequence number
+        :param seq: sequence number
+        :return: byte position
+        """
+
+        try:
+            with open(self._f_name + '.idx') as idx:
+                entries = [tuple(int(v) for v in line.split()) for line in idx if line.strip()]
+        except FileNotFoundError:
+            return 0
+
+        i = bisect.bisect_right(entries, (seq, float('inf'))) - 1
+        return entries[i][1] if i >= 0 else 0
+
+    def tail(self, offset=0):
+        """
+        Creates a reader that returns all events from a sequence number on, including events
+        written later (by any process)
+        :param offset: first sequence number to return
+        :return: LogReader object
+        """
+
+        return LogReader(self, offset)
+
+    def read(self, offset=0):
+        """
+        Reads all events currently in the log from a sequence number on
+        :param offset: first sequence number to return
+        :return: list of Event objects
+        """
+
+        return self.tail(offset).poll()
+
+
+class LogReader:
+    """
+    Reads an event log incrementally, remembering how far it got
+    """
+    def __init__(self, log, offset=0):
+        """
+        Initiates a reader
+        :param log: EventLog object
+        :param offset: first sequence number to return
+        """
+
+        self._log = log
+        self._next_seq = max(offset, 1)
+        self._position = log._position(self._next_seq)
+
+    @property
+    def next_seq(self):
+        """Sequence number of the next event to be returned"""
+        return self._next_seq
+
+    def poll(self):
+        """
+        Returns all complete events that were appended since the last call
+        :return: list of Event objects
+        """
+
+        try:
+            with open(self._log.f_name, 'rb') as f:
+                f.seek(self._position)
+                data = f.read()
+        except FileNotFoundError:
+            return []
+
+        # only consume complete lines, a writer may be in the middle of one
+        end = data.rfind(b'\n') + 1
+        self._position += end
+
+        events = []
+        for line in data[:end].splitlines():
+            event = Event(**json.loads(line))
+            if event.seq >= self._next_seq:
+                events.append(event)
+                self._next_seq = event.seq + 1
+
+        return events
+
+    def follow(self, interval=0.1):
+        """
+        Generator that yields events as they are written, forever
+        :param interval: seconds to wait when there are no new events
+        :return: generator of Event objects
+        """
+
+        while True:
+            events = self.poll()
+            for event in events:
+                yield event
+
+            if not events:
+                time.sleep(interval)
+
+
+# log that all storage mutations are written to
+EVENT_LOG = EventLog()
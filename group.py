@@ -1,9 +1,77 @@
 import uuid
+import weakref
+import contextvars
 from paytrack.io import PersonIO, GroupsIO
+from paytrack.aux import Money, Split
+from paytrack.search import search_persons
 from paytrack.DEFAULTS import *
+import numpy as np
 import pandas as pd
 
 
+# innermost active session of the current thread (or asyncio task)
+_SESSION = contextvars.ContextVar('session', default=None)
+
+
+class Session:
+    """
+    Identity map for a unit of work: inside `with Session():` Person.from_id returns the same
+    person object for an id as long as it is in use, instead of reading it again. Objects are
+    held by weak references, so the map does not keep anybody alive. Outside of a session every
+    load reads the saved state, so objects never go stale across units of work. The active
+    session is kept per thread (per asyncio task), so concurrent requests never share one.
+    """
+
+    def __init__(self):
+        """
+        Initiates an empty session
+        """
+
+        self._persons = weakref.WeakValueDictionary()
+        self._token = None
+
+    def __enter__(self):
+        """Makes this the active session"""
+        self._token = _SESSION.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        """Restores the session that was active before, in this thread only"""
+        _SESSION.reset(self._token)
+        self._token = None
+
+    @staticmethod
+    def current():
+        """
+        Gets the active session
+        :return: Session object, None outside of a session
+        """
+
+        return _SESSION.get()
+
+    def __len__(self):
+        """Number of live persons in the session"""
+        return len(self._persons)
+
+    def get(self, id):
+        """
+        Gets a live person of the session
+        :param id: uuid string
+        :return: Person object, None if there is none
+        """
+
+        return self._persons.get(id)
+
+    def add(self, person):
+        """
+        Registers a person, unless another live object already stands for the same id
+        :param person: Person object
+        :return: None
+        """
+
+        self._persons.setdefault(person.id, person)
+
+
 class Person:
     """
     Object that represents a person
@@ -31,6 +99,10 @@ class Person:
 
         self._add(groups)
 
+        session = Session.current()
+        if session is not None:
+            session.add(self)
+
     def __str__(self):
         """String representation"""
         return self.name
@@ -46,10 +118,10 @@ class Person:
         if not group_ids:
             return
 
-        # if it's a list, concatenate
+        # if it's a list, concatenate (skipping groups the person is already in)
         if type(group_ids) is list:
-            self._groups += group_ids
-        elif type(group_ids) is str:
+            self._groups += [g for g in dict.fromkeys(group_ids) if g not in self._groups]
+        elif type(group_ids) is str and group_ids not in self._groups:
             self._groups.append(group_ids)
 
     def _check_required_attrs(self, kwargs):
@@ -68,15 +140,47 @@ class Person:
     @classmethod
     def from_id(cls, id):
         """
-        Loads a person from its saved ID
+        Loads a person from its saved ID (inside a Session, the object for it that is already in use)
         :param id: uuid string
         :return: Person object with the attributes saved under the respective ID
         """
 
+        session = Session.current()
+        if session is not None:
+            person = session.get(id)
+            if person is not None:
+                return person
+
         # load the data frame with all persons
         groups, attributes = PersonIO.get_person(id)
         return Person(groups=groups, **attributes)
 
+    @classmethod
+    def create_many(cls, attributes):
+        """
+        Creates several new persons, saving them in one batch
+        :param attributes: list of attribute dictionaries, one per person
+        :return: list of Person objects
+        """
+
+        # give every person an id first, so that nothing is saved one by one
+        persons = [Person(**(attrs if 'id' in attrs else dict(attrs, id=str(uuid.uuid4()))))
+                   for attrs in attributes]
+
+        PersonIO.add_persons(persons)
+        return persons
+
+    @classmethod
+    def search(cls, query, k=10):
+        """
+        Finds persons by (the beginning of) their name, tolerating typos
+        :param query: what was typed so far
+        :param k: maximum number of results
+        :return: list of (id, name) tuples
+        """
+
+        return search_persons(query, k)
+
     def _create(self):
         """
         Creates the new person in the person_df
@@ -154,10 +258,8 @@ class Group:
         # save all attributes
         self._attrs = kwargs
 
-        # members list
-        if not people:
-            people = []
-        self._people = people
+        # members list (filled by _add below)
+        self._people = []
 
         # payments
         if not payments:
@@ -168,9 +270,10 @@ class Group:
         if not 'id' in self._attrs.keys():
             id = str(uuid.uuid4())
             self._attrs.update({'id': id})
+            self._add(people)
             self._create()
-
-        self._add(people)
+        else:
+            self._add(people)
 
     def __str__(self):
         """String representation"""
@@ -179,14 +282,55 @@ class Group:
     @classmethod
     def from_id(cls, id):
         """
-        Loads a person from its saved ID
+        Loads a group from its saved ID
         :param id: uuid string
-        :return: Person object with the attributes saved under the respective ID
+        :return: Group object with the attributes and members saved under the respective ID
         """
 
-        # load the data frame with all persons
+        # load the group and its members, the memberships are already saved on both sides
         people, attributes = GroupsIO.get_group(id)
-        return Group(people=[Person.from_id(p.id) for p in people], **attributes)
+        group = Group(**attributes)
+        group._people = [Person.from_id(p) for p in people]
+        return group
+
+    @classmethod
+    def create_with_members(cls, members=None, **kwargs):
+        """
+        Creates a new group with its members, saving everything in one batch instead of
+        rewriting the persons list and every groups list once per member
+        :param members: list of person objects and/or attribute dictionaries of new persons
+        :param kwargs: attributes of the group
+        :return: Group object
+        """
+
+        if not members:
+            members = []
+
+        # stage new persons, everybody is a member once (like _add)
+        people = []
+        new_persons = []
+        ids = set()
+        for m in members:
+            if isinstance(m, Person):
+                p = m
+            else:
+                p = Person(**(m if 'id' in m else dict(m, id=str(uuid.uuid4()))))
+                if p.id not in ids:
+                    new_persons.append(p)
+
+            if p.id not in ids:
+                ids.add(p.id)
+                people.append(p)
+
+        # stage the group (an id is passed, so nothing is saved yet)
+        group = Group(**dict(kwargs, id=str(uuid.uuid4())))
+        group._people = people
+        for p in people:
+            p._add(group.id)
+
+        # save everything at once
+        GroupsIO.add_group_with_members(group, new_persons)
+        return group
 
     def _check_required_attrs(self, kwargs):
         """
@@ -212,19 +356,20 @@ class Group:
         if not people:
             return
 
-        # if it's a list, concatenate
-        if type(people) is list:
-            self._people += people
-
-            # add the group to each person's group list
-            for p in people:
-                p.add_to_groups(self.id)
+        # if it's a single person, make it a list
+        if type(people) is Person:
+            people = [people]
 
-        elif type(people) is Person:
-            self._people.append(people)
+        # add everybody who is not a member yet
+        ids = {p.id for p in self._people}
+        for p in people:
+            if p.id in ids:
+                continue
+            ids.add(p.id)
+            self._people.append(p)
 
             # add the group to the person's group list
-            people.add_to_groups(self)
+            p.add_to_groups(self.id)
 
     def add_people(self, people):
         """
@@ -307,7 +452,8 @@ class Payment:
     """
     Represents payments
     """
-    def __init__(self, by, group_id, amount, people=None, currency=None, location=None, purpose=None):
+    def __init__(self, by, group_id, amount, people=None, currency=None, location=None, purpose=None,
+                 split=None, weights=None):
         """
         Creates a new payment
         :param by: person by whom the payment was made
@@ -315,20 +461,44 @@ class Payment:
         :param people: people in the group for which the payment was made
         :param amount: floating point representation of the amount
         :param currency: string representing the currency
+        :param split: how the amount is split among the people, one of SPLIT_MODES
+        :param weights: dictionary person (or id) -> number of shares, percentage or exact amount
         """
 
         self._by = by
-        self._group_id = group_id
-        self._amount = amount
-
-        if not people:
-            people = group_id.people
-        self._people = people
+        self._group = group_id
 
         if not currency:
             currency = DEFAULT_CURRENCY
         self._currency = currency
 
+        # amounts are kept as integer minor units of the currency (e.g. cents)
+        self._amount_minor = Money.to_minor(amount, currency)
+
+        # weights are keyed by person id
+        if weights:
+            weights = {getattr(p, 'id', p): w for p, w in weights.items()}
+
+        if not people:
+            people = [p for p in group_id.people if p.id in weights] if weights else group_id.people
+        self._people = people
+
+        if not split:
+            split = DEFAULT_SPLIT
+        self._split = split
+
+        if not weights:
+            weights = {getattr(p, 'id', p): 1 for p in people}
+
+        # the ledger only has columns for members, anybody else would be dropped from it
+        if hasattr(group_id, 'people'):
+            members = {p.id for p in group_id.people}
+            outsiders = [k for k in [getattr(by, 'id', by)] + list(weights) if k not in members]
+            if outsiders:
+                raise ValueError('Not members of group {}: {}'.format(group_id.id, ', '.join(map(str, outsiders))))
+
+        self._weights = Split.to_weights(split, self._amount_minor, currency, weights)
+
         if not location:
             location = DEFAULT_LOCATION
         self._location = location
@@ -349,7 +519,9 @@ class Payment:
                        currency=payment_dict['currency'],
                        purpose=payment_dict['purpose'],
                        location=payment_dict['location'],
-                       people=payment_dict['people'])
+                       people=payment_dict['people'],
+                       split=payment_dict.get('split'),
+                       weights=payment_dict.get('weights'))
 
     @property
     def by(self):
@@ -359,18 +531,34 @@ class Payment:
     def group(self):
         return self._group
 
+    @property
+    def group_id(self):
+        return getattr(self._group, 'id', self._group)
+
     @property
     def people(self):
         return self._people
 
     @property
     def amount(self):
-        return self._amount
+        return Money.from_minor(self._amount_minor, self._currency)
+
+    @property
+    def amount_minor(self):
+        return self._amount_minor
 
     @property
     def currency(self):
         return self._currency
 
+    @property
+    def split(self):
+        return self._split
+
+    @property
+    def weights(self):
+        return Split.from_weights(self._split, self._currency, self._weights)
+
     @property
     def purpose(self):
         return self._purpose
@@ -385,18 +573,17 @@ class Payment:
         :return: dataframe representation of the payment
         """
 
-        dct = {'by': [self.by],
-               'amount': [self.amount],
+        dct = {'by': [getattr(self.by, 'id', self.by)],
+               'amount_minor': [self.amount_minor],
                'currency': [self.currency],
                'purpose': [self.purpose],
-               'location': [self.location]}
+               'location': [self.location],
+               'split': [self.split]}
 
-        # add people
-        for p in self.group.people:
-            if p in self.people:
-                dct.update({p.id: [True]})
-            else:
-                dct.update({p.id: [False]})
+        # add the weight of every member (0 for members that did not take part), as one
+        # int64 block instead of one column at a time
+        members = [p.id for p in self.group.people] if hasattr(self.group, 'people') else list(self._weights)
+        weights = np.array([[self._weights.get(p, 0) for p in members]], dtype=np.int64)
 
         # turn into a dataframe and return
-        return pd.DataFrame(dct)
\ No newline at end of file
+        return pd.concat([pd.DataFrame(dct), pd.DataFrame(weights, columns=members)], axis=1)
\ No newline at end of file
@@ -1,8 +1,434 @@
 import pandas as pd
+import numpy as np
 import os
+import time
+import fcntl
+import tempfile
+import zipfile
+from contextlib import contextmanager
+from io import BytesIO
+from paytrack.aux import Money, Split
+from paytrack.cache import ResultCache
+from paytrack import events
+from paytrack.events import EVENT_LOG
 from paytrack.DEFAULTS import *
 
 
+class WriteBatch:
+    """
+    Collects dataframes to be saved as csv files and writes them together. Every file is
+    written once (the last staged version wins), first to a temporary file and then moved
+    into place, so a failing batch leaves no half-written tables behind.
+    """
+    def __init__(self):
+        """
+        Initiates an empty batch
+        """
+
+        self._frames = {}
+
+    def __len__(self):
+        """Number of staged files"""
+        return len(self._frames)
+
+    def add(self, f_name, df):
+        """
+        Stages a dataframe to be saved
+        :param f_name: csv file name
+        :param df: dataframe
+        :return: None
+        """
+
+        self._frames[f_name] = df
+
+    def commit(self):
+        """
+        Writes all staged files
+        :return: None
+        """
+
+        # write everything next to its destination first, into files of this writer only
+        written = {}
+        try:
+            for f_name, df in self._frames.items():
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(f_name) or '.', suffix='.tmp')
+                written[f_name] = tmp
+                with os.fdopen(fd, 'w', newline='') as f:
+                    df.to_csv(f, index=False)
+        except Exception:
+            for tmp in written.values():
+                os.remove(tmp)
+            raise
+
+        # then move all files into place
+        for f_name, tmp in written.items():
+            os.replace(tmp, f_name)
+
+        self._frames = {}
+
+
+class LayoutIO:
+    """
+    Paths of the per-entity files (<id>.csv) in PERSONS_FOLDER, GROUPS_FOLDER, PAYMENTS_FOLDER,
+    LEDGER_VERSIONS_FOLDER and ARCHIVE_FOLDER (<id>.zip). Files are written into the current
+    sharded layout, files that are still in the flat layout or in the sharded layout of an
+    earlier SHARD_LEVELS are found as well until they are migrated.
+    """
+
+    @staticmethod
+    def _path(folder, id, levels, suffix='.csv'):
+        """
+        Path of an entity file in a given layout
+        :param folder: entity folder
+        :param id: uuid of the entity
+        :param levels: number of subdirectory levels
+        :param suffix: file extension
+        :return: file name
+        """
+
+        shards = [id[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(levels)]
+        return os.path.join(folder, *shards, id + suffix)
+
+    @staticmethod
+    def _layouts():
+        """
+        Numbers of subdirectory levels a file can be found at, the current layout first
+        :return: list of numbers of levels
+        """
+
+        return [SHARD_LEVELS] + [levels for levels in range(SHARD_MAX_LEVELS + 1) if levels != SHARD_LEVELS]
+
+    @staticmethod
+    def read_path(folder, id, suffix='.csv'):
+        """
+        Path to read an entity file from, in whichever layout it currently is
+        :param folder: entity folder
+        :param id: uuid of the entity
+        :param suffix: file extension
+        :return: file name (the one in the current layout if the file does not exist)
+        """
+
+        for levels in LayoutIO._layouts():
+            f_name = LayoutIO._path(folder, id, levels, suffix)
+            if os.path.exists(f_name):
+                return f_name
+
+        return LayoutIO._path(folder, id, SHARD_LEVELS, suffix)
+
+    @staticmethod
+    def read_csv(folder, id, **kwargs):
+        """
+        Reads an entity file. A file that migrate moves into the sharded layout between finding
+        and opening it is looked up again once before it counts as missing.
+        :param folder: entity folder
+        :param id: uuid of the entity
+        :param kwargs: keyword arguments of pd.read_csv
+        :return: dataframe
+        """
+
+        try:
+            return pd.read_csv(LayoutIO.read_path(folder, id), **kwargs)
+        except FileNotFoundError:
+            return pd.read_csv(LayoutIO.read_path(folder, id), **kwargs)
+
+    @staticmethod
+    def write_path(folder, id, suffix='.csv'):
+        """
+        Path to write an entity file to, creating its subdirectories
+        :param folder: entity folder
+        :param id: uuid of the entity
+        :param suffix: file extension
+        :return: file name
+        """
+
+        f_name = LayoutIO._path(folder, id, SHARD_LEVELS, suffix)
+        os.makedirs(os.path.dirname(f_name), exist_ok=True)
+        return f_name
+
+    @staticmethod
+    def remove(folder, id, suffix='.csv'):
+        """
+        Deletes an entity file in every layout
+        :param folder: entity folder
+        :param id: uuid of the entity
+        :param suffix: file extension
+        :return: None
+        """
+
+        found = False
+        for levels in LayoutIO._layouts():
+            try:
+                os.remove(LayoutIO._path(folder, id, levels, suffix))
+                found = True
+            except FileNotFoundError:
+                pass
+
+        if not found:
+            raise FileNotFoundError(LayoutIO._path(folder, id, SHARD_LEVELS, suffix))
+
+    @staticmethod
+    def migrate(folder, suffixes=('.csv', '.zip')):
+        """
+        Moves all entity files of a folder into the current layout. This is safe while the
+        app is running: every file is moved atomically, readers find it in either place (and
+        look it up again if it moved under them, see read_csv) and a file that a writer
+        already re-created in the new layout is never overwritten.
+        :param folder: entity folder
+        :param suffixes: extensions of the entity files (lock and temporary files stay)
+        :return: number of moved files
+        """
+
+        moved = 0
+
+        for root, _, files in os.walk(folder):
+            for f in files:
+                suffix = next((x for x in suffixes if f.endswith(x)), None)
+                if suffix is None:
+                    continue
+
+                old = os.path.join(root, f)
+                new = LayoutIO.write_path(folder, f[:-len(suffix)], suffix)
+                if old == new:
+                    continue
+
+                # link instead of rename, so that a newer file is not overwritten
+                try:
+                    os.link(old, new)
+                    moved += 1
+                except FileExistsError:
+                    pass
+                os.remove(old)
+
+        return moved
+
+
+class ArchiveIO:
+    """
+    Cold storage for groups without recent activity. The member list and payment table of a
+    group are packed into one compressed zip file in ARCHIVE_FOLDER (sharded like the hot
+    files). Reads fall back to the archive transparently, keeping the decompressed files in a
+    small cache, and every write to a group promotes it back to hot storage first.
+    """
+
+    # archive member -> folder of the hot file
+    _FILES = {'members.csv': GROUPS_FOLDER, 'payments.csv': PAYMENTS_FOLDER}
+
+    # decompressed files, keyed by (file, group id, archive modification time)
+    _cache = ResultCache(max_entries=ARCHIVE_CACHE_ENTRIES, on_disk=False)
+
+    @staticmethod
+    def _path(group_id):
+        """
+        Path of the archive of a group
+        :param group_id: uuid of a group
+        :return: file name
+        """
+
+        return LayoutIO.read_path(ARCHIVE_FOLDER, group_id, '.zip')
+
+    @staticmethod
+    def is_archived(group_id):
+        """
+        Checks whether a group is in cold storage
+        :param group_id: uuid of a group
+        :return: True or False
+        """
+
+        return os.path.exists(ArchiveIO._path(group_id))
+
+    @staticmethod
+    def _read(group_id, name):
+        """
+        Reads a file from the archive of a group
+        :param group_id: uuid of a group
+        :param name: archive member (a key of _FILES)
+        :return: file content (bytes), None if the group or the file is not archived
+        """
+
+        f_name = ArchiveIO._path(group_id)
+
+        try:
+            version = os.stat(f_name).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+        def decompress():
+            with zipfile.ZipFile(f_name) as z:
+                return z.read(name) if name in z.namelist() else None
+
+        try:
+            return ArchiveIO._cache.get_or_compute(name[:-len('.csv')], group_id, version, decompress)
+        except FileNotFoundError:
+            # promoted in the meantime
+            return None
+
+    @staticmethod
+    def source(folder, group_id):
+        """
+        Where to read the member list or payment table of a group from: the hot file if there
+        is one, otherwise the decompressed file from the archive
+        :param folder: GROUPS_FOLDER or PAYMENTS_FOLDER
+        :param group_id: uuid of a group
+        :return: file name or file-like object, to be passed to pd.read_csv
+        """
+
+        f_name = LayoutIO.read_path(folder, group_id)
+        if os.path.exists(f_name):
+            return f_name
+
+        name = next(n for n, f in ArchiveIO._FILES.items() if f == folder)
+        data = ArchiveIO._read(group_id, name)
+
+        return f_name if data is None else BytesIO(data)
+
+    @staticmethod
+    def read_csv(folder, group_id, **kwargs):
+        """
+        Reads the member list or payment table of a group from hot or cold storage. The file can
+        be archived (or restored) between finding and opening it, so it is looked up again once
+        before it counts as missing.
+        :param folder: GROUPS_FOLDER or PAYMENTS_FOLDER
+        :param group_id: uuid of a group
+        :param kwargs: keyword arguments of pd.read_csv
+        :return: dataframe (a reader if chunksize is given)
+        """
+
+        try:
+            return pd.read_csv(ArchiveIO.source(folder, group_id), **kwargs)
+        except FileNotFoundError:
+            return pd.read_csv(ArchiveIO.source(folder, group_id), **kwargs)
+
+    @staticmethod
+    def last_activity(group_id):
+        """
+        Time of the last change to the members or the ledger of a group
+        :param group_id: uuid of a group
+        :return: modification time of the newest hot file (None if there is none)
+        """
+
+        times = []
+        for folder in list(ArchiveIO._FILES.values()) + [LEDGER_VERSIONS_FOLDER]:
+            try:
+                times.append(os.stat(LayoutIO.read_path(folder, group_id)).st_mtime)
+            except FileNotFoundError:
+                pass
+
+        return max(times, default=None)
+
+    @staticmethod
+    def archive(group_id):
+        """
+        Moves the member list and payment table of a group into cold storage. Holds the ledger
+        lock of the group, so a writer cannot add to the hot files between packing and deleting
+        them.
+        :param group_id: uuid of a group
+        :return: (bytes before, bytes after) tuple, None if there was nothing to archive or a
+        writer changed the group meanwhile
+        """
+
+        with GroupsIO._ledger_lock(group_id):
+            # merge with an existing archive instead of replacing it
+            ArchiveIO.restore(group_id)
+
+            files = {name: LayoutIO.read_path(folder, group_id) for name, folder in ArchiveIO._FILES.items()}
+            files = {name: f_name for name, f_name in files.items() if os.path.exists(f_name)}
+            if not files:
+                return None
+
+            mtimes = {f_name: os.stat(f_name).st_mtime_ns for f_name in files.values()}
+
+            f_name = LayoutIO.write_path(ARCHIVE_FOLDER, group_id, '.zip')
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(f_name), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f, \
+                        zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED, compresslevel=ARCHIVE_COMPRESSLEVEL) as z:
+                    for name, hot in files.items():
+                        z.write(hot, arcname=name)
+
+                # a writer that does not take the ledger lock (add_group) got in between, keep the group hot
+                if any(os.stat(hot).st_mtime_ns != t for hot, t in mtimes.items()):
+                    return None
+
+                before = sum(os.path.getsize(hot) for hot in files.values())
+                after = os.path.getsize(tmp)
+
+                os.replace(tmp, f_name)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+            for name in files:
+                LayoutIO.remove(ArchiveIO._FILES[name], group_id)
+
+            EVENT_LOG.emit(events.GROUP_ARCHIVED, group_id, {'bytes': before, 'archived_bytes': after})
+
+        return before, after
+
+    @staticmethod
+    def restore(group_id):
+        """
+        Promotes a group from cold storage back to hot storage (call it while holding the ledger
+        lock of the group, see GroupsIO._ledger_lock)
+        :param group_id: uuid of a group
+        :return: True if the group was archived
+        """
+
+        f_name = ArchiveIO._path(group_id)
+
+        try:
+            z = zipfile.ZipFile(f_name)
+        except FileNotFoundError:
+            return False
+
+        with z:
+            for name in z.namelist():
+                hot = LayoutIO.write_path(ArchiveIO._FILES[name], group_id)
+
+                # a file that is hot already is newer than the archived one
+                if os.path.exists(hot):
+                    continue
+
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(hot), suffix='.tmp')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(z.read(name))
+                os.replace(tmp, hot)
+
+        os.remove(f_name)
+
+        ArchiveIO._cache.invalidate(group_id)
+        EVENT_LOG.emit(events.GROUP_RESTORED, group_id)
+
+        return True
+
+    @staticmethod
+    def archive_idle(idle_days=ARCHIVE_IDLE_DAYS):
+        """
+        Moves all groups without activity for a number of days into cold storage
+        :param idle_days: number of days
+        :return: dictionary with the number of archived groups and their size before and after
+        """
+
+        limit = time.time() - idle_days * 24 * 3600
+        report = {'groups': 0, 'bytes': 0, 'archived_bytes': 0}
+
+        for group_id in GroupsIO._load_groups_list().loc[:, 'id']:
+            # the ledger version file of an archived group stays hot and old
+            if ArchiveIO.is_archived(group_id):
+                continue
+
+            last = ArchiveIO.last_activity(group_id)
+            if last is None or last > limit:
+                continue
+
+            res = ArchiveIO.archive(group_id)
+            if res is not None:
+                report['groups'] += 1
+                report['bytes'] += res[0]
+                report['archived_bytes'] += res[1]
+
+        return report
+
+
 class PersonIO:
     """
     IO class for persons
@@ -69,6 +495,18 @@ class PersonIO:
         p_list = p_list.append(p_df)
         return p_list
 
+    @staticmethod
+    def _add_persons_to_list(p_list, persons):
+        """
+        Adds several persons to the list at once
+        :param p_list: persons list
+        :param persons: list of person objects
+        :return: persons list
+        """
+
+        p_df = pd.DataFrame([p.attributes for p in persons])
+        p_df.index = p_df.loc[:, 'id']
+        return pd.concat([p_list, p_df])
 
     @staticmethod
     def _extract_person_from_list(p_list, id):
@@ -98,10 +536,8 @@ class PersonIO:
         :return: groups list
         """
 
-        f_name = os.path.join(PERSONS_FOLDER, id + '.csv')
-
         try:
-            groups_df = pd.read_csv(f_name)
+            groups_df = LayoutIO.read_csv(PERSONS_FOLDER, id)
         except FileNotFoundError:
             groups_df = pd.DataFrame(columns=['groups'])
 
@@ -116,7 +552,7 @@ class PersonIO:
         :return: None
         """
 
-        f_name = os.path.join(PERSONS_FOLDER, person.id + '.csv')
+        f_name = LayoutIO.write_path(PERSONS_FOLDER, person.id)
         pd.DataFrame({'groups': person.groups}).to_csv(f_name, index=False)
 
     @staticmethod
@@ -127,8 +563,7 @@ class PersonIO:
         :return: None
         """
 
-        f_name = os.path.join(PERSONS_FOLDER, person.id + '.csv')
-        os.remove(f_name)
+        LayoutIO.remove(PERSONS_FOLDER, person.id)
 
     @staticmethod
     def remove_person(person):
@@ -145,6 +580,8 @@ class PersonIO:
         # remove groups list
         PersonIO._delete_groups_list(person)
 
+        EVENT_LOG.emit(events.PERSON_REMOVED, person.id)
+
     @staticmethod
     def add_person(person):
         """
@@ -159,6 +596,54 @@ class PersonIO:
         # update the groups list
         PersonIO._update_groups_list(person)
 
+        EVENT_LOG.emit(events.PERSON_ADDED, person.id, {'attributes': person.attributes, 'groups': person.groups})
+
+    @staticmethod
+    def _stage_groups_list(batch, person):
+        """
+        Stages the groups list of a person in a write batch
+        :param batch: WriteBatch object
+        :param person: person object
+        :return: None
+        """
+
+        f_name = LayoutIO.write_path(PERSONS_FOLDER, person.id)
+        batch.add(f_name, pd.DataFrame({'groups': person.groups}))
+
+    @staticmethod
+    def _stage_persons(batch, persons):
+        """
+        Stages new persons (persons list and their groups lists) in a write batch
+        :param batch: WriteBatch object
+        :param persons: list of person objects
+        :return: None
+        """
+
+        p_list = PersonIO._load_persons_list()
+        p_list = PersonIO._add_persons_to_list(p_list, persons)
+        batch.add(PERSON_DF, p_list)
+
+        for person in persons:
+            PersonIO._stage_groups_list(batch, person)
+
+    @staticmethod
+    def add_persons(persons):
+        """
+        Adds several persons, rewriting the persons list only once
+        :param persons: list of person objects
+        :return: None
+        """
+
+        if not persons:
+            return
+
+        batch = WriteBatch()
+        PersonIO._stage_persons(batch, persons)
+        batch.commit()
+
+        EVENT_LOG.emit_many([(events.PERSON_ADDED, person.id, {'attributes': person.attributes, 'groups': person.groups})
+                             for person in persons])
+
     @staticmethod
     def update_person(person):
         """
@@ -171,12 +656,16 @@ class PersonIO:
         p_list = PersonIO._update_person_in_list(p_list, person)
         PersonIO._save_persons_list(p_list)
 
+        EVENT_LOG.emit(events.PERSON_UPDATED, person.id, {'attributes': person.attributes})
+
     @staticmethod
     def update_groups_list(person):
 
         # update the groups list for that person
         PersonIO._update_groups_list(person)
 
+        EVENT_LOG.emit(events.PERSON_GROUPS_UPDATED, person.id, {'groups': person.groups})
+
     @staticmethod
     def get_person(id):
         """
@@ -269,10 +758,8 @@ class GroupsIO:
         :return: member list
         """
 
-        f_name = os.path.join(GROUPS_FOLDER, id + '.csv')
-
         try:
-            member_df = pd.read_csv(f_name)
+            member_df = ArchiveIO.read_csv(GROUPS_FOLDER, id)
         except FileNotFoundError:
             member_df = pd.DataFrame(columns=['members'])
 
@@ -287,7 +774,7 @@ class GroupsIO:
         :return: member list
         """
 
-        f_name = os.path.join(GROUPS_FOLDER, group.id + '.csv')
+        f_name = LayoutIO.write_path(GROUPS_FOLDER, group.id)
         pd.DataFrame({'members': [p.id for p in group.people]}).to_csv(f_name, index=False)
 
     @staticmethod
@@ -298,8 +785,7 @@ class GroupsIO:
         :return: None
         """
 
-        f_name = os.path.join(GROUPS_FOLDER, group.id + '.csv')
-        os.remove(f_name)
+        LayoutIO.remove(GROUPS_FOLDER, group.id)
 
     @staticmethod
     def _extract_group_from_list(g_list, id):
@@ -322,20 +808,123 @@ class GroupsIO:
         g_list.to_csv(GROUPS_DF, index=False)
 
     @staticmethod
-    def _load_payment_table(id):
+    def _load_payment_table(id, strict=False):
         """
         Loads the payment table for a group
         :param id: uuid of a group
+        :param strict: if True, raise a ValueError instead of rounding old amounts that are finer
+        than the minor unit (for tables that are written back)
         :return: payment table
         """
 
-        f_name = os.path.join(PAYMENTS_FOLDER, id + '.csv')
-
         try:
-            payment_table = pd.read_csv(f_name)
+            payment_table = ArchiveIO.read_csv(PAYMENTS_FOLDER, id,
+                                               dtype={'amount_minor': 'int64', 'amount': str, 'split': str})
         except FileNotFoundError:
             members = GroupsIO._load_member_list(id)
-            payment_table = pd.DataFrame(columns=['by', 'amount', 'currency', 'purpose', 'location'] + members)
+            payment_table = pd.DataFrame(columns=PAYMENT_TABLE_COLUMNS + members)
+
+        return GroupsIO._normalize_payment_table(payment_table, strict=strict)
+
+    @staticmethod
+    def _chunk_rows(group_id, chunksize=None):
+        """
+        Number of rows per block when streaming a payment table, estimated from the first rows
+        of the table so that computing balances of a block takes about CHUNK_MEMORY bytes
+        :param group_id: uuid of a group
+        :param chunksize: number of rows, if None it is derived from CHUNK_MEMORY
+        :return: number of rows, or None to load the table at once
+        """
+
+        if chunksize is not None or CHUNK_MEMORY is None:
+            return chunksize
+
+        try:
+            sample = ArchiveIO.read_csv(PAYMENTS_FOLDER, group_id, nrows=1000,
+                                        dtype={'amount_minor': 'int64', 'amount': str, 'split': str})
+        except FileNotFoundError:
+            return None
+
+        sample = GroupsIO._normalize_payment_table(sample)
+        if not len(sample):
+            return None
+
+        # text columns count at their real size, numeric cells (amounts and weights) about ten
+        # times: the parser, the normalized copy and the arrays of the balance computation
+        usage = sample.memory_usage(deep=True, index=False)
+        numeric = [c for c in sample.columns if sample[c].dtype != object]
+        row_bytes = (usage.sum() + 9 * usage[numeric].sum()) / len(sample)
+
+        return max(1, int(CHUNK_MEMORY // row_bytes))
+
+    @staticmethod
+    def iter_payment_table(group_id, chunksize=None):
+        """
+        Streams the payment table of a group in blocks of rows, so that peak memory does not
+        depend on the length of the ledger
+        :param group_id: uuid of a group
+        :param chunksize: number of rows per block (None: derived from CHUNK_MEMORY, or the whole table)
+        :return: generator of payment tables
+        """
+
+        chunksize = GroupsIO._chunk_rows(group_id, chunksize)
+        if chunksize is None:
+            yield GroupsIO._load_payment_table(group_id)
+            return
+
+        try:
+            reader = ArchiveIO.read_csv(PAYMENTS_FOLDER, group_id,
+                                        dtype={'amount_minor': 'int64', 'amount': str, 'split': str},
+                                        chunksize=chunksize)
+        except FileNotFoundError:
+            yield GroupsIO._load_payment_table(group_id)
+            return
+
+        with reader:
+            for chunk in reader:
+                yield GroupsIO._normalize_payment_table(chunk)
+
+    @staticmethod
+    def _normalize_payment_table(payment_table, strict=False):
+        """
+        Brings a payment table written by an older version into the current format
+        :param payment_table: payment table as read from the csv file
+        :param strict: if True, raise on amounts that are finer than the minor unit
+        :return: payment table
+        """
+
+        # tables written before amounts were stored in minor units
+        if 'amount' in payment_table.columns:
+            payment_table = GroupsIO._migrate_amounts(payment_table, strict=strict)
+
+        # tables written before unequal splits: flags are equal weights
+        if 'split' not in payment_table.columns:
+            position = list(payment_table.columns).index('location') + 1
+            payment_table.insert(position, 'split', DEFAULT_SPLIT)
+
+        # member columns hold integer weights
+        members = [c for c in payment_table.columns if c not in PAYMENT_TABLE_COLUMNS]
+        if members:
+            payment_table[members] = payment_table.loc[:, members].fillna(0).astype('int64')
+
+        return payment_table
+
+    @staticmethod
+    def _migrate_amounts(payment_table, strict=False):
+        """
+        Replaces the float 'amount' column of an old payment table by integer minor units
+        :param payment_table: payment table with an 'amount' column (read as text)
+        :param strict: if True, raise on amounts that are finer than the minor unit
+        :return: payment table with an 'amount_minor' column
+        """
+
+        minors = Money.to_minor_array(payment_table.loc[:, 'amount'],
+                                      payment_table.loc[:, 'currency'],
+                                      strict=strict)
+
+        position = list(payment_table.columns).index('amount')
+        payment_table = payment_table.drop(columns='amount')
+        payment_table.insert(position, 'amount_minor', minors)
 
         return payment_table
 
@@ -347,33 +936,39 @@ class GroupsIO:
         :return: payment table
         """
 
-        f_name = os.path.join(PAYMENTS_FOLDER, group_id + '.csv')
+        f_name = LayoutIO.write_path(PAYMENTS_FOLDER, group_id)
 
         # get member list and make it a set
         member_list = set(GroupsIO._load_member_list(group_id))
 
         # get persons currently in the payment table and make them a set
-        current_group = set(payments_table.columns) ^ {'by', 'amount', 'currency', 'purpose', 'location'}
+        current_group = set(payments_table.columns) ^ set(PAYMENT_TABLE_COLUMNS)
 
         # add the person
         new_people = member_list ^ current_group
         new_person = new_people.pop()
 
         # add to the payments table
-        payments_table.loc[:, new_person] = False
+        payments_table.loc[:, new_person] = 0
 
         # save
-        payments_table.to_csv(f_name, index=False)
+        with GroupsIO._ledger_lock(group_id):
+            payments_table.to_csv(f_name, index=False)
+            version = GroupsIO._bump_ledger_version(group_id)
+
+            EVENT_LOG.emit(events.LEDGER_MEMBER_ADDED, group_id, {'person': new_person, 'ledger_version': version})
 
     @staticmethod
-    def _add_payment_to_table(payment, payment_table):
+    def _add_payment_to_table(group_id, payment, payment_table):
         """
         Updates the payment table for a group
+        :param group_id: id of the group
+        :param payment: payment object
         :param payment_table: payment table
         :return: payment table
         """
 
-        f_name = os.path.join(PAYMENTS_FOLDER, payment.group_id + '.csv')
+        f_name = LayoutIO.write_path(PAYMENTS_FOLDER, group_id)
 
         # add the line to the payment table
         payment_table = payment_table.append(payment.to_df())
@@ -381,6 +976,66 @@ class GroupsIO:
         # save
         payment_table.to_csv(f_name, index=False)
 
+    @staticmethod
+    def _load_ledger_version(group_id):
+        """
+        Loads the ledger version of a group (0 if the ledger was never changed)
+        :param group_id: uuid of a group
+        :return: version number
+        """
+
+        # looked up again once if the file was moved into the sharded layout meanwhile
+        for retry in (False, True):
+            try:
+                with open(LayoutIO.read_path(LEDGER_VERSIONS_FOLDER, group_id)) as f:
+                    return int(f.read().split()[-1])
+            except FileNotFoundError:
+                if retry:
+                    return 0
+            except (IndexError, ValueError):
+                return 0
+
+    @staticmethod
+    def _bump_ledger_version(group_id):
+        """
+        Increments the ledger version of a group, invalidating all cached results (call it
+        while holding _ledger_lock)
+        :param group_id: uuid of a group
+        :return: new version number
+        """
+
+        f_name = LayoutIO.write_path(LEDGER_VERSIONS_FOLDER, group_id)
+
+        # the caller holds the ledger lock, so concurrent writers get distinct versions (readers
+        # that only need the version never lock, they see the old or the new file)
+        version = GroupsIO._load_ledger_version(group_id) + 1
+        with open(f_name + '.tmp', 'w') as f:
+            f.write('version\n{}\n'.format(version))
+        os.replace(f_name + '.tmp', f_name)
+
+        return version
+
+    @staticmethod
+    @contextmanager
+    def _ledger_lock(group_id, exclusive=True):
+        """
+        Lock on the ledger of a group. Writers hold it exclusively while they change the payment
+        table or the members, bump the version and emit the event, so the events of a group are
+        logged in the order of its versions. Readers that need the data and the version to match
+        (snapshots) share it.
+        :param group_id: uuid of a group
+        :param exclusive: False for a shared (reader) lock
+        :return: context manager
+        """
+
+        f_name = LayoutIO.write_path(LEDGER_VERSIONS_FOLDER, group_id) + '.lock'
+        with open(f_name, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
     @staticmethod
     def _delete_member_list(group):
         """
@@ -389,8 +1044,7 @@ class GroupsIO:
         :return: None
         """
 
-        f_name = os.path.join(GROUPS_FOLDER, group.id + '.csv')
-        os.remove(f_name)
+        LayoutIO.remove(GROUPS_FOLDER, group.id)
 
     @staticmethod
     def remove_group(group):
@@ -404,8 +1058,12 @@ class GroupsIO:
         g_list = GroupsIO._remove_from_list(g_list, group)
         GroupsIO._save_groups_list(g_list)
 
-        # remove group file
-        GroupsIO._delete_member_list(group)
+        # remove group file (restoring an archived group first, so its payment table stays around)
+        with GroupsIO._ledger_lock(group.id):
+            ArchiveIO.restore(group.id)
+            GroupsIO._delete_member_list(group)
+
+            EVENT_LOG.emit(events.GROUP_REMOVED, group.id)
 
     @staticmethod
     def add_group(group):
@@ -421,6 +1079,45 @@ class GroupsIO:
         # update members list
         GroupsIO._update_member_list(group)
 
+        EVENT_LOG.emit(events.GROUP_ADDED, group.id, {'attributes': group.attributes,
+                                                     'members': [p.id for p in group.people]})
+
+    @staticmethod
+    def add_group_with_members(group, new_persons=None):
+        """
+        Adds a group together with its members in one batch: the persons and groups lists
+        and every members and groups list file are written exactly once
+        :param group: group object (its members already list the group)
+        :param new_persons: members that do not exist yet
+        :return: None
+        """
+
+        batch = WriteBatch()
+
+        # new persons
+        if new_persons:
+            PersonIO._stage_persons(batch, new_persons)
+
+        # groups lists of all members
+        for person in group.people:
+            PersonIO._stage_groups_list(batch, person)
+
+        # the group itself
+        g_list = GroupsIO._load_groups_list()
+        g_list = GroupsIO._add_group_to_list(g_list, group)
+        batch.add(GROUPS_DF, g_list)
+
+        # members list
+        f_name = LayoutIO.write_path(GROUPS_FOLDER, group.id)
+        batch.add(f_name, pd.DataFrame({'members': [p.id for p in group.people]}))
+
+        batch.commit()
+
+        EVENT_LOG.emit_many([(events.PERSON_ADDED, person.id, {'attributes': person.attributes, 'groups': person.groups})
+                             for person in new_persons or []] +
+                            [(events.GROUP_ADDED, group.id, {'attributes': group.attributes,
+                                                             'members': [p.id for p in group.people]})])
+
     @staticmethod
     def update_group(group):
         """
@@ -433,6 +1130,8 @@ class GroupsIO:
         g_list = GroupsIO._update_group_in_list(g_list, group)
         GroupsIO._save_groups_list(g_list)
 
+        EVENT_LOG.emit(events.GROUP_UPDATED, group.id, {'attributes': group.attributes})
+
     @staticmethod
     def update_group_members(group):
         """
@@ -441,7 +1140,23 @@ class GroupsIO:
         :return: None
         """
         # update members list
-        GroupsIO._update_member_list(group)
+        with GroupsIO._ledger_lock(group.id):
+            ArchiveIO.restore(group.id)
+            GroupsIO._update_member_list(group)
+            version = GroupsIO._bump_ledger_version(group.id)
+
+            EVENT_LOG.emit(events.GROUP_MEMBERS_UPDATED, group.id, {'members': [p.id for p in group.people],
+                                                                   'ledger_version': version})
+
+    @staticmethod
+    def get_ledger_version(group_id):
+        """
+        Get the ledger version of a group, it changes whenever payments or members change
+        :param group_id: id of the group
+        :return: version number
+        """
+
+        return GroupsIO._load_ledger_version(group_id)
 
     @staticmethod
     def get_group(id):
@@ -461,42 +1176,40 @@ class GroupsIO:
         return m_list, attrs
 
     @staticmethod
-    def get_payments(group_id, n=None):
+    def _payment_dicts(group_id, payments_table):
         """
-        Get all payments of a group
+        Turns the rows of a payment table into payment dictionaries
         :param group_id: id for the group
-        :return: dictionary with the payment details
+        :param payments_table: payment table
+        :return: list of dictionaries with the payment details
         """
 
-        payments_table = GroupsIO._load_payment_table(group_id)
-
-        s = len(payments_table)
-
-        if n is None or n > s:
-            n = s
+        # get persons currently in the payment table
+        cols = PAYMENT_TABLE_COLUMNS
+        whole_group = np.array([c for c in payments_table.columns if c not in set(cols)], dtype=object)
 
-        table_slice = payments_table[s-n:s, :]
-
-        # get persons currently in the payment table and make them a set
-        cols = ['by', 'amount', 'currency', 'purpose', 'location']
-        whole_group = set(payments_table.columns) ^ set(cols)
+        # participants of every payment as index arrays into the member columns, instead of
+        # looking at every member of every row
+        weights = payments_table.loc[:, whole_group].to_numpy(dtype=np.int64)
+        records = payments_table.loc[:, cols].to_dict('records')
 
         # loop over rows and create dicts
         res = []
-        for _, row in table_slice:
+        for record, row in zip(records, weights):
 
-            payment_dict = {}
+            payment_dict = {'group_id': group_id}
 
-            # get the people
-            people = []
-            for p in whole_group:
-                if row[p]:
-                    people.append(p)
-            payment_dict.update({'people': people})
+            # get the people and their weights
+            participants = np.flatnonzero(row)
+            stored = dict(zip(whole_group[participants].tolist(), row[participants].tolist()))
+            payment_dict.update({'people': list(stored.keys())})
+            payment_dict.update({'weights': Split.from_weights(record['split'], record['currency'], stored)})
 
             # get all other variables
-            for col in cols:
-                payment_dict.update({col: row[col]})
+            payment_dict.update(record)
+
+            # amounts leave the storage layer in the currency, not in minor units
+            payment_dict.update({'amount': Money.from_minor(record['amount_minor'], record['currency'])})
 
             # append to the result list
             res.append(payment_dict)
@@ -504,6 +1217,77 @@ class GroupsIO:
         # return the result
         return res
 
+    @staticmethod
+    def get_payments(group_id, n=None, chunksize=None):
+        """
+        Get all payments of a group
+        :param group_id: id for the group
+        :param n: number of most recent payments (all if None)
+        :param chunksize: rows per block when streaming the table (see iter_payment_table)
+        :return: list of dictionaries with the payment details
+        """
+
+        # keep only the last n rows while streaming
+        chunks = []
+        for chunk in GroupsIO.iter_payment_table(group_id, chunksize):
+            chunks.append(chunk)
+            if n is not None:
+                chunks = [pd.concat(chunks)]
+                chunks[0] = chunks[0].iloc[max(len(chunks[0]) - n, 0):]
+
+        return GroupsIO._payment_dicts(group_id, pd.concat(chunks))
+
+    @staticmethod
+    def query_payments(group_id, by=None, person=None, currency=None, chunksize=None):
+        """
+        Get the payments of a group that match all given conditions
+        :param group_id: id for the group
+        :param by: id of the person who paid
+        :param person: id of a person who took part
+        :param currency: string representing the currency
+        :param chunksize: rows per block when streaming the table (see iter_payment_table)
+        :return: list of dictionaries with the payment details
+        """
+
+        res = []
+        for chunk in GroupsIO.iter_payment_table(group_id, chunksize):
+            mask = pd.Series(True, index=chunk.index)
+
+            if by is not None:
+                mask &= chunk.loc[:, 'by'] == by
+            if currency is not None:
+                mask &= chunk.loc[:, 'currency'] == currency
+            if person is not None:
+                mask &= chunk.loc[:, person] != 0 if person in chunk.columns else False
+
+            res += GroupsIO._payment_dicts(group_id, chunk.loc[mask])
+
+        return res
+
+    @staticmethod
+    def export_payments(group_id, f_name, chunksize=None):
+        """
+        Exports the payments of a group as a csv file with amounts in their currency
+        :param group_id: id for the group
+        :param f_name: file to write
+        :param chunksize: rows per block when streaming the table (see iter_payment_table)
+        :return: number of exported payments
+        """
+
+        n = 0
+        with open(f_name, 'w', newline='') as f:
+            for chunk in GroupsIO.iter_payment_table(group_id, chunksize):
+                chunk = chunk.copy()
+                position = list(chunk.columns).index('amount_minor')
+                chunk.insert(position, 'amount', [Money.to_string(m, c) for m, c in
+                                                  zip(chunk.loc[:, 'amount_minor'], chunk.loc[:, 'currency'])])
+
+                # the header only goes on top of the first block
+                chunk.drop(columns='amount_minor').to_csv(f, index=False, header=f.tell() == 0)
+                n += len(chunk)
+
+        return n
+
     @staticmethod
     def add_payment(group_id, payment):
         """
@@ -513,5 +1297,58 @@ class GroupsIO:
         :return: None
         """
 
-        payments_table = GroupsIO._load_payment_table(group_id)
-        GroupsIO._add_payment_to_table(payments_table, payment)
\ No newline at end of file
+        with GroupsIO._ledger_lock(group_id):
+            # a new payment brings an archived group back to hot storage
+            ArchiveIO.restore(group_id)
+
+            # payments built without the group object are checked against the saved members
+            payment_df = payment.to_df()
+            members = set(GroupsIO._load_member_list(group_id))
+            involved = [payment_df.loc[0, 'by']] + [c for c in payment_df.columns
+                                                    if c not in PAYMENT_TABLE_COLUMNS and payment_df.loc[0, c]]
+            outsiders = [k for k in involved if k not in members]
+            if outsiders:
+                raise ValueError('Not members of group {}: {}'.format(group_id, ', '.join(map(str, outsiders))))
+
+            # the table is written back, so an old table is only converted if that is lossless
+            payments_table = GroupsIO._load_payment_table(group_id, strict=True)
+            GroupsIO._add_payment_to_table(group_id, payment, payments_table)
+            version = GroupsIO._bump_ledger_version(group_id)
+
+            EVENT_LOG.emit(events.PAYMENT_ADDED, group_id, {'payment': payment_df.to_dict('records')[0],
+                                                           'ledger_version': version})
+
+    @staticmethod
+    def migrate_payment_table(group_id):
+        """
+        Rewrites an old payment table (float amounts, boolean members) in the current format
+        of integer minor units and weights. Raises a ValueError (and leaves the file untouched)
+        if an amount cannot be converted exactly. Holds the ledger lock, so that no payment is
+        added between reading and writing back the table.
+        :param group_id: id of the group
+        :return: True if the table was migrated, False if there was nothing to do
+        """
+
+        with GroupsIO._ledger_lock(group_id):
+            ArchiveIO.restore(group_id)
+            f_name = LayoutIO.write_path(PAYMENTS_FOLDER, group_id)
+
+            try:
+                payment_table = LayoutIO.read_csv(PAYMENTS_FOLDER, group_id, dtype={'amount': str, 'split': str})
+            except FileNotFoundError:
+                return False
+
+            if 'amount' not in payment_table.columns and 'split' in payment_table.columns:
+                return False
+
+            payment_table = GroupsIO._normalize_payment_table(payment_table, strict=True)
+
+            # readers see the old or the new table, never half of it
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(f_name), suffix='.tmp')
+            with os.fdopen(fd, 'w', newline='') as f:
+                payment_table.to_csv(f, index=False)
+            os.replace(tmp, f_name)
+
+            EVENT_LOG.emit(events.PAYMENT_TABLE_MIGRATED, group_id)
+
+        return True
@@ -0,0 +1,256 @@
+import os
+import time
+import random
+import traceback
+import multiprocessing
+from collections import Counter
+import numpy as np
+import pandas as pd
+from paytrack.bench import data_tree
+from paytrack.io import PersonIO, GroupsIO, LayoutIO
+from paytrack.group import Person, Group, Payment
+from paytrack.DEFAULTS import *
+
+OPERATIONS = ['create_person', 'create_group', 'add_people', 'add_payment', 'get_group', 'get_payments']
+DEFAULT_MIX = {'create_person': 1, 'create_group': 1, 'add_people': 2,
+               'add_payment': 4, 'get_group': 4, 'get_payments': 4}
+
+
+def parse_mix(text):
+    """
+    Parses an operation mix like 'add_payment=4,get_group=1'
+    :param text: comma separated operation=weight pairs
+    :return: dictionary operation -> weight
+    """
+
+    mix = {}
+    for item in text.split(','):
+        op, weight = item.split('=')
+        if op not in OPERATIONS:
+            raise ValueError('Unknown operation: \'{}\''.format(op))
+        mix[op] = float(weight)
+
+    return mix
+
+
+class _Worker:
+    """
+    Runs random operations against the data tree and records what it changed
+    """
+    def __init__(self, seed, person_ids, outsider_ids, shared_group_id):
+        """
+        Initiates a worker
+        :param seed: random seed
+        :param person_ids: ids of the persons created before the run
+        :param outsider_ids: ids of those persons that are not in the shared group
+        :param shared_group_id: id of the group all workers write to
+        """
+
+        self._random = random.Random(seed)
+        self._seed = seed
+        self._person_ids = list(person_ids)
+        self._outsider_ids = list(outsider_ids)
+        self._group_ids = [shared_group_id]
+        self._shared_group_id = shared_group_id
+
+        # what this worker expects to find afterwards
+        self.persons = []
+        self.groups = []
+        self.memberships = []
+        self.payments = Counter()
+
+    def _group_id(self):
+        """Picks a group, mostly the shared one"""
+        if self._random.random() < 0.8:
+            return self._shared_group_id
+        return self._random.choice(self._group_ids)
+
+    def create_person(self):
+        """Creates a new person"""
+        p = Person(name='Person {}-{}'.format(self._seed, len(self.persons)))
+        self.persons.append(p.id)
+        self._person_ids.append(p.id)
+        self._outsider_ids.append(p.id)
+
+    def create_group(self):
+        """Creates a group with two random persons"""
+        members = [Person.from_id(id) for id in self._random.sample(self._person_ids, 2)]
+        g = Group.create_with_members(members, name='Group {}-{}'.format(self._seed, len(self.groups)))
+        self.groups.append(g.id)
+        self._group_ids.append(g.id)
+        self.memberships += [(g.id, p.id) for p in members]
+
+    def add_people(self):
+        """Adds a random person to a group, one that was not in the shared group at the start"""
+        g = Group.from_id(self._group_id())
+        p = Person.from_id(self._random.choice(self._outsider_ids or self._person_ids))
+        g.add_people([p])
+        self.memberships.append((g.id, p.id))
+
+    def add_payment(self):
+        """Adds a payment to a group"""
+        g = Group.from_id(self._group_id())
+        GroupsIO.add_payment(g.id, Payment(g.people[0], g, self._random.randint(1, 10000) / 100))
+        self.payments[g.id] += 1
+
+    def get_group(self):
+        """Reads a group"""
+        GroupsIO.get_group(self._group_id())
+
+    def get_payments(self):
+        """Reads the payments of a group"""
+        GroupsIO.get_payments(self._group_id())
+
+
+def _run_worker(args):
+    """
+    Process entry point: runs a number of random operations
+    :param args: (root, seed, n, mix, person_ids, outsider_ids, shared_group_id) tuple
+    :return: dictionary with the latencies, errors and expectations of the worker
+    """
+
+    root, seed, n, mix, person_ids, outsider_ids, shared_group_id = args
+    os.chdir(root)
+
+    worker = _Worker(seed, person_ids, outsider_ids, shared_group_id)
+    ops = list(mix.keys())
+    weights = [mix[op] for op in ops]
+
+    latencies = {op: [] for op in ops}
+    errors = Counter()
+    first_error = {}
+
+    for op in worker._random.choices(ops, weights=weights, k=n):
+        start = time.perf_counter()
+        try:
+            getattr(worker, op)()
+            latencies[op].append(time.perf_counter() - start)
+        except Exception:
+            errors[op] += 1
+            first_error.setdefault(op, traceback.format_exc(limit=1).strip().splitlines()[-1])
+
+    return {'latencies': latencies,
+            'errors': dict(errors),
+            'first_error': first_error,
+            'persons': worker.persons,
+            'groups': worker.groups,
+            'memberships': worker.memberships,
+            'payments': dict(worker.payments)}
+
+
+def _read_list(folder, id, column):
+    """
+    Reads a members or groups list file
+    :param folder: entity folder
+    :param id: uuid of the entity
+    :param column: column to read
+    :return: set of ids (empty if the file is missing or damaged)
+    """
+
+    try:
+        return set(LayoutIO.read_csv(folder, id).loc[:, column])
+    except (FileNotFoundError, pd.errors.EmptyDataError, KeyError):
+        return set()
+
+
+def check_integrity(results, initial_person_ids, initial_group_ids):
+    """
+    Checks the data tree after a run against what the workers did
+    :param results: list of worker results
+    :param initial_person_ids: ids of the persons created before the run
+    :param initial_group_ids: ids of the groups created before the run
+    :return: dictionary problem -> number of occurrences (all zero if the data is intact)
+    """
+
+    persons = set(PersonIO._load_persons_list().loc[:, 'id'])
+    groups = set(GroupsIO._load_groups_list().loc[:, 'id'])
+
+    expected_persons = set(initial_person_ids).union(*[r['persons'] for r in results])
+    expected_groups = set(initial_group_ids).union(*[r['groups'] for r in results])
+
+    members = {g: _read_list(GROUPS_FOLDER, g, 'members') for g in groups}
+    memberships = {p: _read_list(PERSONS_FOLDER, p, 'groups') for p in persons}
+
+    report = {'lost_persons': len(expected_persons - persons),
+              'lost_groups': len(expected_groups - groups),
+              'lost_memberships': 0,
+              'one_sided_memberships': 0,
+              'lost_payments': 0}
+
+    # every membership a worker added is recorded on the group side
+    for r in results:
+        for g, p in r['memberships']:
+            if p not in members.get(g, set()):
+                report['lost_memberships'] += 1
+
+    # memberships are consistent in both directions
+    for g, m in members.items():
+        report['one_sided_memberships'] += sum(g not in memberships.get(p, set()) for p in m)
+    for p, gs in memberships.items():
+        report['one_sided_memberships'] += sum(p not in members.get(g, set()) for g in gs if g in groups)
+
+    # every payment a worker added is in its ledger
+    expected_payments = Counter()
+    for r in results:
+        expected_payments.update(r['payments'])
+    for g, n in expected_payments.items():
+        report['lost_payments'] += max(0, n - len(GroupsIO._load_payment_table(g)))
+
+    return report
+
+
+def run(processes=4, operations=200, mix=None, initial_persons=20, outside_persons=20, seed=0):
+    """
+    Runs a load test in a temporary data tree: several processes run a random mix of
+    operations against the same group at once
+    :param processes: number of worker processes
+    :param operations: number of operations per process
+    :param mix: dictionary operation -> weight (defaults to DEFAULT_MIX)
+    :param initial_persons: number of persons in the shared group before the run
+    :param outside_persons: number of persons outside of it, which add_people adds to groups
+    :param seed: random seed
+    :return: dictionary with the throughput, per-operation statistics and the integrity report
+    """
+
+    if mix is None:
+        mix = DEFAULT_MIX
+
+    with data_tree() as root:
+
+        # the group everybody hits
+        group = Group.create_with_members([{'name': 'Person {}'.format(i)} for i in range(initial_persons)],
+                                          name='Shared group')
+        # persons that add_people can really add, so that memberships are contended too
+        outsider_ids = [p.id for p in Person.create_many([{'name': 'Outsider {}'.format(i)}
+                                                          for i in range(outside_persons)])]
+        person_ids = [p.id for p in group.people] + outsider_ids
+
+        args = [(root, seed + i, operations, mix, person_ids, outsider_ids, group.id) for i in range(processes)]
+
+        start = time.perf_counter()
+        with multiprocessing.get_context().Pool(processes) as pool:
+            results = pool.map(_run_worker, args)
+        duration = time.perf_counter() - start
+
+        integrity = check_integrity(results, person_ids, [group.id])
+
+    # latency percentiles per operation
+    stats = {}
+    for op in mix:
+        latencies = np.concatenate([r['latencies'].get(op, []) for r in results]) * 1000
+        errors = sum(r['errors'].get(op, 0) for r in results)
+        stats[op] = {'count': len(latencies),
+                     'errors': errors,
+                     'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                     'p95_ms': float(np.percentile(latencies, 95)) if len(latencies) else None,
+                     'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+                     'first_error': next((r['first_error'][op] for r in results if op in r['first_error']), None)}
+
+    total = sum(s['count'] for s in stats.values())
+
+    return {'processes': processes,
+            'operations': processes * operations,
+            'duration_s': duration,
+            'throughput_ops': total / duration,
+            'stats': stats,
+            'integrity': integrity}
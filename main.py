@@ -0,0 +1,156 @@
+import argparse
+from paytrack.DEFAULTS import *
+
+
+def _bench(args):
+    """
+    Runs a benchmark and prints the result
+    :param args: parsed command line arguments
+    :return: None
+    """
+
+    from paytrack import bench
+
+    if args.name == 'create-group':
+        res = bench.bench_group_creation(args.n)
+    elif args.name == 'chunked-balances':
+        res = bench.bench_chunked_balances(args.n)
+    elif args.name == 'name-search':
+        res = bench.bench_name_search(args.n)
+    elif args.name == 'membership':
+        res = bench.bench_membership(args.n)
+    elif args.name == 'archive':
+        res = bench.bench_archive(args.n)
+
+    for k, v in res.items():
+        print('{:>18}: {}'.format(k, round(v, 4) if type(v) is float else v))
+
+
+def _migrate_layout(args):
+    """
+    Moves the per-entity files into the current (sharded) layout
+    :param args: parsed command line arguments
+    :return: None
+    """
+
+    from paytrack.io import LayoutIO
+
+    for folder in [PERSONS_FOLDER, GROUPS_FOLDER, PAYMENTS_FOLDER, LEDGER_VERSIONS_FOLDER, ARCHIVE_FOLDER]:
+        print('{}: {} files moved'.format(folder, LayoutIO.migrate(folder)))
+
+
+def _snapshot(args):
+    """
+    Exports a read-only snapshot of all data
+    :param args: parsed command line arguments
+    :return: None
+    """
+
+    from paytrack.snapshot import SnapshotIO
+
+    print(SnapshotIO.export(args.folder))
+
+
+def _archive(args):
+    """
+    Moves groups without recent activity into compressed cold storage
+    :param args: parsed command line arguments
+    :return: None
+    """
+
+    from paytrack.io import ArchiveIO
+
+    report = ArchiveIO.archive_idle(args.days)
+    print('{} groups archived: {} bytes -> {} bytes'.format(report['groups'], report['bytes'], report['archived_bytes']))
+
+
+def _events(args):
+    """
+    Prints the storage events from an offset on, one json line per event
+    :param args: parsed command line arguments
+    :return: None
+    """
+
+    import json
+    from paytrack.events import EVENT_LOG
+
+    reader = EVENT_LOG.tail(args.offset)
+    for event in (reader.follow() if args.follow else reader.poll()):
+        print(json.dumps(event._asdict()), flush=True)
+
+
+def _loadtest(args):
+    """
+    Runs a multi-process load test and prints latencies and the integrity report
+    :param args: parsed command line arguments
+    :return: None
+    """
+
+    from paytrack import loadtest
+
+    mix = loadtest.parse_mix(args.mix) if args.mix else None
+    res = loadtest.run(processes=args.processes, operations=args.operations, mix=mix,
+                       initial_persons=args.persons, outside_persons=args.outsiders, seed=args.seed)
+
+    print('{} processes, {} operations in {:.2f} s: {:.1f} ops/s'.format(
+        res['processes'], res['operations'], res['duration_s'], res['throughput_ops']))
+
+    print('{:>14} {:>7} {:>7} {:>9} {:>9} {:>9}'.format('operation', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for op, s in res['stats'].items():
+        print('{:>14} {:>7} {:>7} {:>9} {:>9} {:>9}'.format(
+            op, s['count'], s['errors'],
+            *['-' if s[k] is None else '{:.1f}'.format(s[k]) for k in ['p50_ms', 'p95_ms', 'p99_ms']]))
+
+    for op, s in res['stats'].items():
+        if s['first_error']:
+            print('first {} error: {}'.format(op, s['first_error']))
+
+    print('integrity:', ', '.join('{}={}'.format(k, v) for k, v in res['integrity'].items()))
+
+
+def main(argv=None):
+    """
+    Command line interface, run as `python -m paytrack.main <command>`
+    :param argv: list of arguments (defaults to sys.argv)
+    :return: None
+    """
+
+    parser = argparse.ArgumentParser(prog='paytrack')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('bench', help='run a benchmark in a temporary data tree')
+    p.add_argument('name', choices=['create-group', 'chunked-balances', 'name-search', 'membership', 'archive'])
+    p.add_argument('-n', type=int, default=200, help='problem size (e.g. number of people)')
+    p.set_defaults(func=_bench)
+
+    p = commands.add_parser('migrate-layout', help='move the files under data/server into the sharded layout')
+    p.set_defaults(func=_migrate_layout)
+
+    p = commands.add_parser('snapshot', help='export a read-only, memory-mappable snapshot for analytics')
+    p.add_argument('--folder', default=SNAPSHOT_FOLDER, help='snapshot folder')
+    p.set_defaults(func=_snapshot)
+
+    p = commands.add_parser('archive', help='move inactive groups into compressed cold storage')
+    p.add_argument('--days', type=float, default=ARCHIVE_IDLE_DAYS, help='days without activity')
+    p.set_defaults(func=_archive)
+
+    p = commands.add_parser('events', help='print the storage event log')
+    p.add_argument('--offset', type=int, default=1, help='first sequence number to print')
+    p.add_argument('-f', '--follow', action='store_true', help='keep printing new events')
+    p.set_defaults(func=_events)
+
+    p = commands.add_parser('loadtest', help='run concurrent workers against a temporary data tree')
+    p.add_argument('-p', '--processes', type=int, default=4, help='number of worker processes')
+    p.add_argument('-n', '--operations', type=int, default=200, help='operations per process')
+    p.add_argument('--mix', help='operation weights, e.g. add_payment=4,get_group=1')
+    p.add_argument('--persons', type=int, default=20, help='members of the shared group at the start')
+    p.add_argument('--outsiders', type=int, default=20, help='persons outside of it, which add_people adds')
+    p.add_argument('--seed', type=int, default=0, help='random seed')
+    p.set_defaults(func=_loadtest)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+import numpy as np
+import pandas as pd
+from paytrack.io import GroupsIO
+from paytrack.aux import Money, Split
+from paytrack.cache import ResultCache
+from paytrack.DEFAULTS import *
+
+# shared cache for computed results, keyed by group id and ledger version
+RESULT_CACHE = ResultCache()
+
+
+class Ledger:
+    """
+    Computes balances and settlements from the payment table of a group
+    """
+
+    @staticmethod
+    def _members(payment_table):
+        """
+        Gets the member columns of a payment table
+        :param payment_table: payment table
+        :return: list of member ids
+        """
+
+        table_columns = set(PAYMENT_TABLE_COLUMNS)
+        return [c for c in payment_table.columns if c not in table_columns]
+
+    @staticmethod
+    def compute_balances(payment_table):
+        """
+        Computes how much each member paid minus how much they owe, exactly in minor units
+        :param payment_table: payment table
+        :return: int64 dataframe with one row per member and one column per currency
+        """
+
+        members = Ledger._members(payment_table)
+        currencies = list(payment_table.loc[:, 'currency'].unique())
+
+        # a payer without a column (saved before payments were checked) gets a row of their own,
+        # so that the balances still add up to zero
+        columns = set(members)
+        payer_rows = members + [p for p in payment_table.loc[:, 'by'].unique() if p not in columns]
+        balances = pd.DataFrame(0, index=payer_rows, columns=currencies, dtype=np.int64)
+
+        if len(payment_table) == 0:
+            return balances
+
+        # split the whole ledger at once according to every payment's weights
+        amounts = payment_table.loc[:, 'amount_minor'].to_numpy(dtype=np.int64)
+        weights = payment_table.loc[:, members].to_numpy(dtype=np.int64)
+        owed = Split.owed(amounts, payment_table.loc[:, 'split'].to_numpy(), weights)
+        owed = np.pad(owed, ((0, 0), (0, len(payer_rows) - len(members))))
+
+        # what was paid, one column per member
+        payers = pd.Categorical(payment_table.loc[:, 'by'], categories=payer_rows).codes
+        paid = np.zeros_like(owed)
+        rows = np.arange(len(payment_table))
+        paid[rows, payers] = amounts
+
+        # sum per currency as one product with the (payments x currencies) indicator matrix
+        codes = pd.Categorical(payment_table.loc[:, 'currency'], categories=currencies).codes
+        indicator = np.zeros((len(payment_table), len(currencies)), dtype=np.int64)
+        indicator[np.arange(len(payment_table)), codes] = 1
+        balances.loc[:, :] = (paid - owed).T @ indicator
+
+        return balances
+
+    @staticmethod
+    def compute_balances_chunked(chunks):
+        """
+        Computes balances from a payment table that is streamed in blocks of rows, by adding
+        up the (exact, integer) balances of every block
+        :param chunks: iterable of payment tables with the same columns
+        :return: int64 dataframe with one row per member and one column per currency
+        """
+
+        total = None
+        currencies = []
+
+        for chunk in chunks:
+            part = Ledger.compute_balances(chunk)
+            currencies += [c for c in part.columns if c not in currencies]
+            if total is None:
+                total = part
+                continue
+
+            # align on int64 with zeros before adding, add(fill_value=0) goes through float64
+            # and loses cents above 2**53
+            index = total.index.union(part.index)
+            total = (total.reindex(index=index, columns=currencies, fill_value=0).astype(np.int64) +
+                     part.reindex(index=index, columns=currencies, fill_value=0).astype(np.int64))
+
+        # keep the currencies in order of first appearance, like compute_balances
+        return total.reindex(columns=currencies, fill_value=0).astype(np.int64)
+
+    @staticmethod
+    def compute_settlements(balances):
+        """
+        Computes the transfers that settle all balances, matching the largest debtor
+        with the largest creditor until everything is paid back
+        :param balances: balances in minor units as returned by compute_balances
+        :return: list of dictionaries with 'from', 'to', 'amount_minor' and 'currency'
+        """
+
+        transfers = []
+
+        for currency in balances.columns:
+            remaining = {k: int(v) for k, v in balances.loc[:, currency].items()}
+
+            while True:
+                debtor = min(remaining, key=remaining.get, default=None)
+                creditor = max(remaining, key=remaining.get, default=None)
+
+                if debtor is None or remaining[debtor] >= 0 or remaining[creditor] <= 0:
+                    break
+
+                amount = min(-remaining[debtor], remaining[creditor])
+                remaining[debtor] += amount
+                remaining[creditor] -= amount
+
+                transfers.append({'from': debtor,
+                                  'to': creditor,
+                                  'amount_minor': amount,
+                                  'currency': currency})
+
+        return transfers
+
+    @staticmethod
+    def _balances_to_major(balances):
+        """
+        Converts balances from minor units into float amounts of their currency
+        :param balances: balances as returned by compute_balances
+        :return: float dataframe
+        """
+
+        return pd.DataFrame({c: balances.loc[:, c] / 10. ** Money.exponent(c) for c in balances.columns},
+                            index=balances.index, columns=balances.columns)
+
+    @staticmethod
+    def _get_balances_minor(group_id, chunksize=None):
+        """
+        Get the balances of a group in minor units, served from the result cache while the ledger is unchanged
+        :param group_id: id of the group
+        :param chunksize: rows per block when streaming the table (see GroupsIO.iter_payment_table)
+        :return: int64 dataframe with one row per member and one column per currency
+        """
+
+        version = GroupsIO.get_ledger_version(group_id)
+        return RESULT_CACHE.get_or_compute(
+            'balances', group_id, version,
+            lambda: Ledger.compute_balances_chunked(GroupsIO.iter_payment_table(group_id, chunksize)))
+
+    @staticmethod
+    def get_balances(group_id, chunksize=None):
+        """
+        Get the balances of a group
+        :param group_id: id of the group
+        :param chunksize: rows per block when streaming the table (see GroupsIO.iter_payment_table)
+        :return: dataframe with one row per member and one column per currency
+        """
+
+        return Ledger._balances_to_major(Ledger._get_balances_minor(group_id, chunksize))
+
+    @staticmethod
+    def get_settlements(group_id, chunksize=None):
+        """
+        Get the transfers that settle a group, served from the result cache while the ledger is unchanged
+        :param group_id: id of the group
+        :param chunksize: rows per block when streaming the table (see GroupsIO.iter_payment_table)
+        :return: list of dictionaries with 'from', 'to', 'amount' and 'currency'
+        """
+
+        version = GroupsIO.get_ledger_version(group_id)
+        transfers = RESULT_CACHE.get_or_compute(
+            'settlements', group_id, version,
+            lambda: Ledger.compute_settlements(Ledger._get_balances_minor(group_id, chunksize)))
+
+        return [dict(t, amount=Money.from_minor(t['amount_minor'], t['currency'])) for t in transfers]
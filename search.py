@@ -0,0 +1,329 @@
+import os
+import bisect
+import heapq
+import itertools
+import pickle
+import unicodedata
+from collections import Counter, defaultdict
+from paytrack.io import PersonIO
+from paytrack import events
+from paytrack.events import EVENT_LOG
+from paytrack.DEFAULTS import *
+
+
+def normalize(name):
+    """
+    Normalizes a name for searching: no accents, case folded, single spaces
+    :param name: name
+    :return: normalized name
+    """
+
+    decomposed = unicodedata.normalize('NFKD', str(name))
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(stripped.casefold().split())
+
+
+def _trigrams(normalized):
+    """
+    Gets the trigrams of a normalized name (padded, so that short names have some too)
+    :param normalized: normalized name
+    :return: set of trigrams
+    """
+
+    padded = '  ' + normalized + ' '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    """
+    Index over the names of all persons for typeahead search.
+
+    Prefix search runs on a sorted list of keys, one per word of a name onwards ('anna smith'
+    and 'smith'), so it takes a binary search plus k steps. Fuzzy search falls back to
+    trigram postings. The index follows the event log, so it picks up add_person,
+    update_person (change_name) and remove_person from every process, and it is saved with
+    the sequence number of the last applied event, so loading it only replays what is new.
+    """
+    def __init__(self, f_name=NAME_INDEX_FILE):
+        """
+        Initiates an empty index
+        :param f_name: file the index is saved to
+        """
+
+        self._f_name = f_name
+        self._names = {}
+        self._keys = []
+        self._key_ids = []
+        self._postings = defaultdict(set)
+        self._seq = 0
+        self._reader = None
+        self._unsaved = 0
+
+    def __len__(self):
+        """Number of indexed persons"""
+        return len(self._names)
+
+    @staticmethod
+    def _entries(normalized):
+        """
+        Gets the prefix keys of a normalized name
+        :param normalized: normalized name
+        :return: list of keys
+        """
+
+        words = normalized.split(' ')
+        return [' '.join(words[i:]) for i in range(len(words))]
+
+    def add(self, id, name):
+        """
+        Adds a person to the index (or updates their name)
+        :param id: uuid of the person
+        :param name: name of the person
+        :return: None
+        """
+
+        if id in self._names:
+            self.remove(id)
+
+        normalized = normalize(name)
+        trigrams = _trigrams(normalized)
+        self._names[id] = (name, normalized, len(trigrams))
+
+        for key in self._entries(normalized):
+            i = bisect.bisect_right(self._keys, key)
+            self._keys.insert(i, key)
+            self._key_ids.insert(i, id)
+
+        for t in trigrams:
+            self._postings[t].add(id)
+
+    def remove(self, id):
+        """
+        Removes a person from the index
+        :param id: uuid of the person
+        :return: None
+        """
+
+        if id not in self._names:
+            return
+
+        _, normalized, _ = self._names.pop(id)
+
+        for key in self._entries(normalized):
+            i = bisect.bisect_left(self._keys, key)
+            while self._key_ids[i] != id:
+                i += 1
+            del self._keys[i]
+            del self._key_ids[i]
+
+        for t in _trigrams(normalized):
+            self._postings[t].discard(id)
+            if not self._postings[t]:
+                del self._postings[t]
+
+    def _apply(self, event):
+        """
+        Applies a storage event
+        :param event: Event object
+        :return: None
+        """
+
+        if event.seq <= self._seq:
+            return
+
+        if event.type in (events.PERSON_ADDED, events.PERSON_UPDATED):
+            self.add(event.entity_id, event.payload['attributes']['name'])
+        elif event.type == events.PERSON_REMOVED:
+            self.remove(event.entity_id)
+
+        self._seq = event.seq
+
+    def refresh(self):
+        """
+        Applies all events written since the index was last updated (also by other processes)
+        :return: number of applied events
+        """
+
+        if self._reader is None:
+            self._reader = EVENT_LOG.tail(self._seq + 1)
+
+        new = self._reader.poll()
+        for event in new:
+            self._apply(event)
+
+        self._unsaved += len(new)
+        return len(new)
+
+    def prefix(self, query, k=10):
+        """
+        Finds persons with a word of their name starting with the query
+        :param query: beginning of a name
+        :param k: maximum number of results
+        :return: list of (id, name) tuples, names starting with the query first
+        """
+
+        q = normalize(query)
+        found = {}
+
+        i = bisect.bisect_left(self._keys, q)
+        while i < len(self._keys) and self._keys[i].startswith(q) and len(found) < 4 * k:
+            id = self._key_ids[i]
+            found.setdefault(id, self._names[id][1].startswith(q))
+            i += 1
+
+        # whole-name matches first, then shorter names
+        ranked = sorted(found, key=lambda id: (not found[id], len(self._names[id][1]), self._names[id][1]))
+        return [(id, self._names[id][0]) for id in ranked[:k]]
+
+    def fuzzy(self, query, k=10, max_candidates=NAME_INDEX_MAX_CANDIDATES, max_postings=NAME_INDEX_MAX_POSTINGS):
+        """
+        Finds persons whose name is similar to the query (shared trigrams), to survive typos
+        :param query: (part of) a name
+        :param k: maximum number of results
+        :param max_candidates: number of candidates to score at most
+        :param max_postings: number of postings to walk at most, rarest trigrams first
+        :return: list of (id, name) tuples, most similar first
+        """
+
+        trigrams = sorted(_trigrams(normalize(query)), key=lambda t: len(self._postings.get(t, ())))
+
+        # count shared trigrams over the rarest postings while the budget lasts, a trigram like
+        # '  a' is too common to be walked and only brings in candidates if there are few
+        shared = Counter()
+        budget = max_postings
+        rare = 0
+        for t in trigrams:
+            postings = self._postings.get(t, set())
+            if len(postings) > budget:
+                shared.update(dict.fromkeys(itertools.islice(postings, budget), 0))
+                break
+            shared.update(postings)
+            budget -= len(postings)
+            rare += 1
+
+        # keep the best candidates, and look the common trigrams up for those only
+        if len(shared) > max_candidates:
+            shared = Counter(dict(shared.most_common(max_candidates)))
+        for t in trigrams[rare:]:
+            shared.update(self._postings.get(t, set()).intersection(shared))
+
+        # dice coefficient
+        best = heapq.nlargest(k, shared, key=lambda id: 2 * shared[id] / (len(trigrams) + self._names[id][2]))
+        return [(id, self._names[id][0]) for id in best]
+
+    def search(self, query, k=10):
+        """
+        Typeahead search: prefix matches, or fuzzy matches if there are none
+        :param query: what was typed so far
+        :param k: maximum number of results
+        :return: list of (id, name) tuples
+        """
+
+        self.refresh()
+
+        # a typo, no name starts with the query
+        res = self.prefix(query, k)
+        if not res:
+            res = self.fuzzy(query, k)
+
+        return res
+
+    def save(self):
+        """
+        Saves the index together with the sequence number of the last applied event
+        :return: None
+        """
+
+        state = {'seq': self._seq, 'names': self._names, 'keys': self._keys,
+                 'key_ids': self._key_ids, 'postings': dict(self._postings)}
+
+        os.makedirs(os.path.dirname(self._f_name) or '.', exist_ok=True)
+        with open(self._f_name + '.tmp', 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self._f_name + '.tmp', self._f_name)
+
+        self._unsaved = 0
+
+    @classmethod
+    def build(cls, f_name=NAME_INDEX_FILE):
+        """
+        Builds the index from the persons list
+        :param f_name: file the index is saved to
+        :return: NameIndex object
+        """
+
+        index = cls(f_name)
+
+        # events after this one are replayed on top of the persons list (adding twice is harmless)
+        try:
+            with open(EVENT_LOG.f_name, 'rb') as f:
+                index._seq = EVENT_LOG._last_seq(f)
+        except FileNotFoundError:
+            index._seq = 0
+
+        # one pass over all names and a single sort, add() is for incremental updates only
+        p_list = PersonIO._load_persons_list()
+        entries = []
+        for id, name in dict(zip(p_list.loc[:, 'id'], p_list.loc[:, 'name'])).items():
+            normalized = normalize(name)
+            trigrams = _trigrams(normalized)
+            index._names[id] = (name, normalized, len(trigrams))
+
+            entries += [(key, id) for key in cls._entries(normalized)]
+            for t in trigrams:
+                index._postings[t].add(id)
+
+        entries.sort()
+        index._keys = [key for key, _ in entries]
+        index._key_ids = [id for _, id in entries]
+
+        return index
+
+    @classmethod
+    def load(cls, f_name=NAME_INDEX_FILE):
+        """
+        Loads the saved index (or builds it) and brings it up to date
+        :param f_name: file the index is saved to
+        :return: NameIndex object
+        """
+
+        try:
+            with open(f_name, 'rb') as f:
+                state = pickle.load(f)
+
+            index = cls(f_name)
+            index._seq = state['seq']
+            index._names = state['names']
+            index._keys = state['keys']
+            index._key_ids = state['key_ids']
+            index._postings = defaultdict(set, state['postings'])
+        except FileNotFoundError:
+            index = cls.build(f_name)
+            index._unsaved = NAME_INDEX_SAVE_INTERVAL
+
+        # saving happens here, never on the search path
+        index.refresh()
+        if index._unsaved >= NAME_INDEX_SAVE_INTERVAL:
+            index.save()
+
+        return index
+
+
+# index used by search_persons, loaded on first use
+_NAME_INDEX = None
+
+
+def search_persons(query, k=10):
+    """
+    Typeahead search over the names of all persons
+    :param query: what was typed so far
+    :param k: maximum number of results
+    :return: list of (id, name) tuples
+    """
+
+    global _NAME_INDEX
+
+    if _NAME_INDEX is None or _NAME_INDEX._f_name != os.path.abspath(NAME_INDEX_FILE):
+        _NAME_INDEX = NameIndex.load(os.path.abspath(NAME_INDEX_FILE))
+
+    return _NAME_INDEX.search(query, k)
@@ -0,0 +1,525 @@
+import os
+import json
+import mmap
+import tempfile
+import datetime
+import numpy as np
+from paytrack.io import PersonIO, GroupsIO
+from paytrack.aux import Money, Split
+from paytrack.DEFAULTS import *
+
+# file layout: magic, header length (uint64), json header, arrays aligned to ALIGNMENT bytes
+MAGIC = b'PTSNAP01'
+ALIGNMENT = 64
+FORMAT_VERSION = 1
+
+
+class _StringTable:
+    """
+    Interns strings and stores them as one utf-8 blob with offsets
+    """
+    def __init__(self):
+        """
+        Initiates an empty string table
+        """
+
+        self._index = {}
+        self._strings = []
+
+    def add(self, s):
+        """
+        Adds a string (if it is new)
+        :param s: string
+        :return: index of the string
+        """
+
+        s = str(s)
+        if s not in self._index:
+            self._index[s] = len(self._strings)
+            self._strings.append(s)
+
+        return self._index[s]
+
+    def add_many(self, strings):
+        """
+        Adds several strings
+        :param strings: iterable of strings
+        :return: int32 array of indices
+        """
+
+        return np.array([self.add(s) for s in strings], dtype=np.int32)
+
+    def arrays(self):
+        """
+        Gets the arrays representing the table
+        :return: (offsets, data) tuple of numpy arrays
+        """
+
+        encoded = [s.encode('utf-8') for s in self._strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+
+        return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+def _json_default(o):
+    """Makes numpy scalars json serializable"""
+    return o.item()
+
+
+def _keys(ids):
+    """
+    Turns ids into a sorted fixed width byte array for binary search
+    :param ids: list of ids
+    :return: (keys, order) tuple, order maps sorted positions to the positions in ids
+    """
+
+    encoded = np.array([str(i).encode('utf-8') for i in ids], dtype=bytes)
+    if not len(encoded):
+        encoded = encoded.astype('S1')
+
+    order = np.argsort(encoded, kind='stable')
+    return encoded[order], order
+
+
+def _csr(lists):
+    """
+    Turns a list of lists into (indptr, values) arrays
+    :param lists: list of int arrays
+    :return: (indptr, values) tuple
+    """
+
+    indptr = np.zeros(len(lists) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(l) for l in lists])
+    values = np.concatenate(lists) if lists else np.zeros(0)
+
+    return indptr, values
+
+
+class SnapshotIO:
+    """
+    Exports all persons, groups, memberships and payment ledgers into one read-only,
+    memory-mappable snapshot file
+    """
+
+    @staticmethod
+    def _load_group_state(group_id):
+        """
+        Loads the members and the payment table of a group at one ledger version, holding the
+        ledger lock that writers take while they change them and bump the version
+        :param group_id: uuid of a group
+        :return: (ledger version, members list, payment table) tuple
+        """
+
+        with GroupsIO._ledger_lock(group_id, exclusive=False):
+            version = GroupsIO.get_ledger_version(group_id)
+            members = GroupsIO._load_member_list(group_id)
+            payment_table = GroupsIO._load_payment_table(group_id)
+
+        return version, members, payment_table
+
+    @staticmethod
+    def _load_group(strings, group_id):
+        """
+        Reads a group at one ledger version and turns it into its part of the snapshot arrays
+        right away, so that only one payment table is in memory at a time
+        :param strings: _StringTable object
+        :param group_id: uuid of a group
+        :return: dictionary with the version, members and the payment arrays of the group
+        """
+
+        version, members, payment_table = SnapshotIO._load_group_state(group_id)
+        group = {'version': version, 'members': members, 'member_strings': strings.add_many(members),
+                 'rows': len(payment_table), 'columns': {}}
+
+        for c in PAYMENT_TABLE_COLUMNS:
+            if c == 'amount_minor':
+                group['columns'][c] = payment_table.loc[:, c].to_numpy(dtype=np.int64)
+            else:
+                group['columns'][c] = strings.add_many(payment_table.loc[:, c])
+
+        # non-zero weights, row by row in column order
+        table_members = [c for c in payment_table.columns if c not in PAYMENT_TABLE_COLUMNS]
+        weights = payment_table.loc[:, table_members].to_numpy(dtype=np.int64)
+        r, c = np.nonzero(weights)
+        group['weight_counts'] = np.bincount(r, minlength=len(payment_table))
+        group['weight_members'] = strings.add_many(table_members)[c]
+        group['weight_values'] = weights[r, c]
+
+        return group
+
+    @staticmethod
+    def _mismatches(person_groups, group_members):
+        """
+        Cross-checks the memberships read from the persons and from the groups
+        :param person_groups: dictionary person id -> groups list
+        :param group_members: dictionary group id -> members list
+        :return: (person ids, group ids) tuple of sets, of memberships recorded on one side only
+        """
+
+        persons = {p: set(g) for p, g in person_groups.items()}
+        groups = {g: set(m) for g, m in group_members.items()}
+        torn_persons, torn_groups = set(), set()
+
+        # removed persons and groups may still be listed on the other side, that is not a tear
+        for g, members in groups.items():
+            for p in members:
+                if p in persons and g not in persons[p]:
+                    torn_persons.add(p)
+                    torn_groups.add(g)
+
+        for p, gs in persons.items():
+            for g in gs:
+                if g in groups and p not in groups[g]:
+                    torn_persons.add(p)
+                    torn_groups.add(g)
+
+        return torn_persons, torn_groups
+
+    @staticmethod
+    def _list_snapshots(folder):
+        """
+        Lists the versions of all snapshots in a folder
+        :param folder: snapshot folder
+        :return: sorted list of versions
+        """
+
+        try:
+            files = os.listdir(folder)
+        except FileNotFoundError:
+            return []
+
+        return sorted(int(f[len('snapshot-'):-len('.bin')]) for f in files
+                      if f.startswith('snapshot-') and f.endswith('.bin'))
+
+    @staticmethod
+    def _write_bundle(f_name, header, arrays):
+        """
+        Writes a header and arrays into a new file
+        :param f_name: file name
+        :param header: json serializable dictionary
+        :param arrays: dictionary name -> numpy array
+        :return: True, False if the file exists already
+        """
+
+        # place the arrays, the offsets are relative to the start of the data section
+        header = dict(header, arrays={})
+        offset = 0
+        for name, arr in arrays.items():
+            header['arrays'][name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+            offset += -(-arr.nbytes // ALIGNMENT) * ALIGNMENT
+
+        encoded = json.dumps(header, default=_json_default).encode('utf-8')
+        start = -(-(len(MAGIC) + 8 + len(encoded)) // ALIGNMENT) * ALIGNMENT
+
+        # write a temporary file of this writer, then publish it without replacing anything
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(f_name) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(MAGIC)
+                f.write(np.uint64(len(encoded)).tobytes())
+                f.write(encoded)
+                for name, arr in arrays.items():
+                    f.seek(start + header['arrays'][name]['offset'])
+                    f.write(np.ascontiguousarray(arr).tobytes())
+                f.truncate(start + offset)
+
+            os.link(tmp, f_name)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp)
+
+    @staticmethod
+    def export(folder=SNAPSHOT_FOLDER, retries=5):
+        """
+        Freezes the current data into a new snapshot. Every payment ledger is read at a single
+        ledger version (recorded in the snapshot) under the ledger lock, one group at a time.
+        Persons, groups and memberships are read one after the other, so memberships that the
+        persons and the groups do not agree on are read again; if they still do not after all
+        retries (a one-sided membership left behind by a crashed writer), the snapshot is
+        written but marked as not consistent, and only opened when asked for explicitly (see
+        SnapshotReader).
+        :param folder: snapshot folder
+        :param retries: number of times to read the disagreeing persons and groups again
+        :return: file name of the snapshot
+        """
+
+        strings = _StringTable()
+        arrays = {}
+
+        p_list = PersonIO._load_persons_list()
+        person_groups = {id: PersonIO._load_groups_list(id) for id in p_list.loc[:, 'id']}
+
+        g_list = GroupsIO._load_groups_list()
+        groups = {id: SnapshotIO._load_group(strings, id) for id in g_list.loc[:, 'id']}
+
+        # a membership recorded on one side only was being written, read the persons and groups
+        # involved again (strings of the replaced parts stay in the table unused)
+        for attempt in range(retries + 1):
+            torn_persons, torn_groups = SnapshotIO._mismatches(
+                person_groups, {id: group['members'] for id, group in groups.items()})
+            if attempt == retries or not (torn_persons or torn_groups):
+                break
+
+            for id in torn_persons:
+                person_groups[id] = PersonIO._load_groups_list(id)
+            for id in torn_groups:
+                groups[id] = SnapshotIO._load_group(strings, id)
+
+        consistent = not (torn_persons or torn_groups)
+
+        # persons, sorted by id
+        person_ids = list(p_list.loc[:, 'id'])
+        arrays['person_keys'], order = _keys(person_ids)
+        records = p_list.to_dict('records')
+        arrays['person_attrs'] = strings.add_many(json.dumps(records[i], default=_json_default) for i in order)
+        arrays['person_groups_indptr'], arrays['person_groups'] = _csr(
+            [strings.add_many(person_groups[person_ids[i]]) for i in order])
+        arrays['person_groups'] = arrays['person_groups'].astype(np.int32)
+
+        # groups, sorted by id
+        group_ids = list(g_list.loc[:, 'id'])
+        arrays['group_keys'], order = _keys(group_ids)
+        records = g_list.to_dict('records')
+        arrays['group_attrs'] = strings.add_many(json.dumps(records[i], default=_json_default) for i in order)
+
+        # members and payment ledgers
+        ordered = [groups[group_ids[i]] for i in order]
+
+        arrays['group_versions'] = np.array([g['version'] for g in ordered], dtype=np.int64)
+        arrays['group_members_indptr'], arrays['group_members'] = _csr([g['member_strings'] for g in ordered])
+        arrays['group_members'] = arrays['group_members'].astype(np.int32)
+        arrays['group_payments_indptr'] = np.concatenate([[0], np.cumsum([g['rows'] for g in ordered])]).astype(np.int64)
+
+        for c in PAYMENT_TABLE_COLUMNS:
+            dtype = np.int64 if c == 'amount_minor' else np.int32
+            values = [g['columns'][c] for g in ordered]
+            arrays['payment_' + c] = np.concatenate(values).astype(dtype) if values else np.zeros(0, dtype=dtype)
+
+        counts = np.concatenate([g['weight_counts'] for g in ordered]) if ordered else np.zeros(0, dtype=np.int64)
+        arrays['payment_weights_indptr'] = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        arrays['payment_weight_members'] = _csr([g['weight_members'] for g in ordered])[1].astype(np.int32)
+        arrays['payment_weight_values'] = _csr([g['weight_values'] for g in ordered])[1].astype(np.int64)
+
+        arrays['string_offsets'], arrays['string_data'] = strings.arrays()
+
+        # write it as the next version, a concurrent export that took that version first makes
+        # this one move on to the one after
+        os.makedirs(folder, exist_ok=True)
+        while True:
+            existing = SnapshotIO._list_snapshots(folder)
+            version = existing[-1] + 1 if existing else 1
+
+            header = {'format': FORMAT_VERSION,
+                      'version': version,
+                      'created': datetime.datetime.utcnow().isoformat(),
+                      'consistent': consistent}
+
+            f_name = os.path.join(folder, 'snapshot-{}.bin'.format(version))
+            if SnapshotIO._write_bundle(f_name, header, arrays):
+                return f_name
+
+    @staticmethod
+    def _read_header(f_name):
+        """
+        Reads the header of a snapshot
+        :param f_name: snapshot file
+        :return: (header, start of the data section) tuple
+        """
+
+        with open(f_name, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{} is not a snapshot'.format(f_name))
+
+            length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(length).decode('utf-8'))
+
+        return header, -(-(len(MAGIC) + 8 + length) // ALIGNMENT) * ALIGNMENT
+
+    @staticmethod
+    def latest(folder=SNAPSHOT_FOLDER, allow_inconsistent=False):
+        """
+        Gets the file name of the newest snapshot
+        :param folder: snapshot folder
+        :param allow_inconsistent: if False, skip snapshots whose memberships did not agree
+        :return: file name
+        """
+
+        for version in reversed(SnapshotIO._list_snapshots(folder)):
+            f_name = os.path.join(folder, 'snapshot-{}.bin'.format(version))
+            if allow_inconsistent or SnapshotIO._read_header(f_name)[0].get('consistent', True):
+                return f_name
+
+        raise FileNotFoundError('No {}snapshot in {}'.format('' if allow_inconsistent else 'consistent ', folder))
+
+
+class SnapshotReader:
+    """
+    Read-only access to a snapshot with the query surface of PersonIO and GroupsIO. The file
+    is memory-mapped, so all reader processes share one copy in the page cache.
+    """
+    def __init__(self, f_name=None, allow_inconsistent=False):
+        """
+        Opens a snapshot
+        :param f_name: snapshot file (defaults to the newest consistent one)
+        :param allow_inconsistent: if True, also open a snapshot whose memberships did not agree
+        """
+
+        if f_name is None:
+            f_name = SnapshotIO.latest(allow_inconsistent=allow_inconsistent)
+
+        self._header, start = SnapshotIO._read_header(f_name)
+
+        if self._header['format'] != FORMAT_VERSION:
+            raise ValueError('Unsupported snapshot format {}'.format(self._header['format']))
+        if not (allow_inconsistent or self._header.get('consistent', True)):
+            raise ValueError('{} is not consistent, open it with allow_inconsistent=True'.format(f_name))
+
+        with open(f_name, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # views into the mapped file, nothing is copied
+        self._arrays = {}
+        for name, spec in self._header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            count = int(np.prod(spec['shape']))
+            self._arrays[name] = np.frombuffer(self._mm, dtype=dtype, count=count,
+                                               offset=start + spec['offset']).reshape(spec['shape'])
+
+    @property
+    def version(self):
+        """Version of the snapshot"""
+        return self._header['version']
+
+    @property
+    def created(self):
+        """Creation time of the snapshot (utc, iso format)"""
+        return self._header['created']
+
+    @property
+    def consistent(self):
+        """False if the memberships recorded by persons and groups did not agree (see SnapshotIO.export)"""
+        return self._header.get('consistent', True)
+
+    def _string(self, i):
+        """
+        Gets a string from the string table
+        :param i: index
+        :return: string
+        """
+
+        offsets = self._arrays['string_offsets']
+        return bytes(self._arrays['string_data'][offsets[i]:offsets[i + 1]]).decode('utf-8')
+
+    def _strings(self, indices):
+        """
+        Gets several strings from the string table
+        :param indices: iterable of indices
+        :return: list of strings
+        """
+
+        return [self._string(i) for i in indices]
+
+    def _find(self, keys, id):
+        """
+        Finds the position of an id in a sorted key array
+        :param keys: name of the key array
+        :param id: id to look up
+        :return: position
+        """
+
+        arr = self._arrays[keys]
+        key = str(id).encode('utf-8')
+        i = int(np.searchsorted(arr, key))
+
+        if i == len(arr) or arr[i] != key:
+            raise KeyError(id)
+
+        return i
+
+    def get_person(self, id):
+        """
+        Get a person, given its id
+        :param id: uuid of the person
+        :return: (groups list, dictionary with all person attributes) tuple
+        """
+
+        i = self._find('person_keys', id)
+        indptr = self._arrays['person_groups_indptr']
+        groups = self._strings(self._arrays['person_groups'][indptr[i]:indptr[i + 1]])
+
+        return groups, json.loads(self._string(self._arrays['person_attrs'][i]))
+
+    def get_group(self, id):
+        """
+        Get a group, given its id
+        :param id: uuid of the group
+        :return: (members list, dictionary with all group attributes) tuple
+        """
+
+        i = self._find('group_keys', id)
+        indptr = self._arrays['group_members_indptr']
+        members = self._strings(self._arrays['group_members'][indptr[i]:indptr[i + 1]])
+
+        return members, json.loads(self._string(self._arrays['group_attrs'][i]))
+
+    def get_ledger_version(self, group_id):
+        """
+        Get the ledger version of a group at the time of the snapshot
+        :param group_id: id of the group
+        :return: version number
+        """
+
+        return int(self._arrays['group_versions'][self._find('group_keys', group_id)])
+
+    def get_payments(self, group_id, n=None):
+        """
+        Get the payments of a group
+        :param group_id: id for the group
+        :param n: number of most recent payments (all if None)
+        :return: list of dictionaries with the payment details
+        """
+
+        i = self._find('group_keys', group_id)
+        first, last = self._arrays['group_payments_indptr'][i:i + 2]
+
+        if n is not None and n < last - first:
+            first = last - n
+
+        a = self._arrays
+        indptr = a['payment_weights_indptr']
+
+        res = []
+        for row in range(first, last):
+
+            payment_dict = {'group_id': group_id}
+
+            # get the people and their weights
+            start, end = indptr[row], indptr[row + 1]
+            stored = dict(zip(self._strings(a['payment_weight_members'][start:end]),
+                              a['payment_weight_values'][start:end].tolist()))
+            split = self._string(a['payment_split'][row])
+            currency = self._string(a['payment_currency'][row])
+            payment_dict.update({'people': list(stored.keys())})
+            payment_dict.update({'weights': Split.from_weights(split, currency, stored)})
+
+            # get all other variables
+            for col in ['by', 'currency', 'purpose', 'location', 'split']:
+                payment_dict.update({col: self._string(a['payment_' + col][row])})
+            payment_dict.update({'amount_minor': int(a['payment_amount_minor'][row])})
+            payment_dict.update({'amount': Money.from_minor(payment_dict['amount_minor'], currency)})
+
+            res.append(payment_dict)
+
+        return res
+
+    def close(self):
+        """
+        Unmaps the snapshot
+        :return: None
+        """
+
+        self._arrays = {}
+        self._mm.close()
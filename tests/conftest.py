@@ -0,0 +1,9 @@
+import pytest
+from paytrack.bench import data_tree
+
+
+@pytest.fixture
+def tree():
+    """Runs a test in a fresh, empty data tree"""
+    with data_tree() as root:
+        yield root
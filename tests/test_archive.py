@@ -0,0 +1,101 @@
+import os
+import time
+import multiprocessing
+from paytrack import events
+from paytrack.events import EVENT_LOG
+from paytrack.group import Group, Payment
+from paytrack.io import ArchiveIO, GroupsIO, LayoutIO
+from paytrack.payments import Ledger
+from paytrack.DEFAULTS import *
+
+
+def _group(n_payments=3):
+    group = Group.create_with_members([{'name': 'A'}, {'name': 'B'}, {'name': 'C'}], name='G')
+    for i in range(n_payments):
+        GroupsIO.add_payment(group.id, Payment(group.people[i % 3], group, 10 + i))
+    return group
+
+
+def _make_idle(group_id, days):
+    past = time.time() - days * 24 * 3600
+    for folder in [GROUPS_FOLDER, PAYMENTS_FOLDER, LEDGER_VERSIONS_FOLDER]:
+        os.utime(LayoutIO.read_path(folder, group_id), (past, past))
+
+
+def _archive_loop(args):
+    root, group_id, n = args
+    os.chdir(root)
+    for _ in range(n):
+        ArchiveIO.archive(group_id)
+
+
+def _add_payments(args):
+    root, group_id, n = args
+    os.chdir(root)
+    group = Group.from_id(group_id)
+    for _ in range(n):
+        GroupsIO.add_payment(group_id, Payment(group.people[0], group, 10))
+
+
+def test_archive_and_restore(tree):
+    group = _group()
+    members = GroupsIO._load_member_list(group.id)
+    payments = GroupsIO.get_payments(group.id)
+    balances = Ledger.compute_balances(GroupsIO._load_payment_table(group.id))
+
+    before, after = ArchiveIO.archive(group.id)
+
+    assert after < before
+    assert ArchiveIO.is_archived(group.id)
+    assert not os.path.exists(LayoutIO.read_path(PAYMENTS_FOLDER, group.id))
+    assert not os.path.exists(LayoutIO.read_path(GROUPS_FOLDER, group.id))
+
+    # reads fall back to the archive
+    assert GroupsIO._load_member_list(group.id) == members
+    assert GroupsIO.get_payments(group.id) == payments
+    assert Ledger.compute_balances(GroupsIO._load_payment_table(group.id)).equals(balances)
+
+    # a write brings the group back
+    GroupsIO.add_payment(group.id, Payment(group.people[0], group, 1))
+    assert not ArchiveIO.is_archived(group.id)
+    assert len(GroupsIO.get_payments(group.id)) == len(payments) + 1
+
+    types = [e.type for e in EVENT_LOG.read()]
+    assert types.index(events.GROUP_ARCHIVED) < types.index(events.GROUP_RESTORED)
+
+
+def test_archive_idle(tree):
+    idle, archived, active = _group(), _group(), _group()
+    for group in [idle, archived]:
+        _make_idle(group.id, 100)
+    ArchiveIO.archive(archived.id)
+
+    report = ArchiveIO.archive_idle(idle_days=90)
+
+    assert report['groups'] == 1
+    assert ArchiveIO.is_archived(idle.id) and ArchiveIO.is_archived(archived.id)
+    assert not ArchiveIO.is_archived(active.id)
+
+
+def test_remove_archived_group_keeps_its_ledger(tree):
+    group = _group()
+    ArchiveIO.archive(group.id)
+
+    GroupsIO.remove_group(group)
+
+    assert not ArchiveIO.is_archived(group.id)
+    assert len(GroupsIO._load_payment_table(group.id)) == 3
+
+
+def test_no_payment_is_lost_while_archiving(tree):
+    group = _group(0)
+
+    args = [(tree, group.id, 300)] + [(tree, group.id, 10)] * 3
+    with multiprocessing.get_context('fork').Pool(4) as pool:
+        results = [pool.apply_async(_archive_loop, (args[0],))] + \
+                  [pool.apply_async(_add_payments, (a,)) for a in args[1:]]
+        for r in results:
+            r.get()
+
+    assert len(GroupsIO._load_payment_table(group.id)) == 30
+    assert GroupsIO.get_ledger_version(group.id) == 30
@@ -0,0 +1,69 @@
+import os
+import multiprocessing
+from paytrack.cache import ResultCache
+from paytrack.io import GroupsIO
+
+
+def _bump(args):
+    root, group_id, n = args
+    os.chdir(root)
+    for _ in range(n):
+        with GroupsIO._ledger_lock(group_id):
+            GroupsIO._bump_ledger_version(group_id)
+
+
+def _save(args):
+    root, value = args
+    os.chdir(root)
+    ResultCache(on_disk=True)._save_to_disk(('balances', 'group-1', 1), value)
+
+
+def _files(root):
+    return sorted(f for _, _, files in os.walk(root) for f in files)
+
+
+def test_concurrent_bumps_get_distinct_versions(tree):
+    with multiprocessing.get_context('fork').Pool(4) as pool:
+        pool.map(_bump, [(tree, 'group-1', 25)] * 4)
+
+    assert GroupsIO.get_ledger_version('group-1') == 100
+
+
+def test_memory_and_disk_tiers(tree):
+    calls = []
+    cache = ResultCache(max_entries=2, on_disk=True)
+
+    def compute(value):
+        return lambda: calls.append(value) or value
+
+    assert cache.get_or_compute('balances', 'group-1', 1, compute('a')) == 'a'
+    assert cache.get_or_compute('balances', 'group-1', 1, compute('b')) == 'a'
+    assert cache.hits == 1 and calls == ['a']
+
+    # a new process finds the entry on disk
+    other = ResultCache(on_disk=True)
+    assert other.get_or_compute('balances', 'group-1', 1, compute('c')) == 'a'
+    assert other.disk_hits == 1 and calls == ['a']
+
+    # a new version is computed again and replaces the old one on disk
+    assert cache.get_or_compute('balances', 'group-1', 2, compute('d')) == 'd'
+    cache.get_or_compute('settlements', 'group-1', 2, compute('e'))
+    assert _files(tree) == ['balances_2.pkl', 'settlements_2.pkl']
+
+
+def test_eviction(tree):
+    cache = ResultCache(max_entries=2)
+    for version in range(3):
+        cache.get_or_compute('balances', 'group-1', version, lambda: version)
+
+    assert len(cache) == 2 and cache.evictions == 1
+
+
+def test_concurrent_saves(tree):
+    with multiprocessing.get_context('fork').Pool(4) as pool:
+        pool.map(_save, [(tree, list(range(i, i + 10000))) for i in range(16)])
+
+    # one complete entry, no temporary files left behind
+    assert _files(tree) == ['balances_1.pkl']
+    found, value = ResultCache(on_disk=True)._load_from_disk(('balances', 'group-1', 1))
+    assert found and value == list(range(value[0], value[0] + 10000))
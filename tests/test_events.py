@@ -0,0 +1,82 @@
+import os
+import multiprocessing
+import pytest
+from paytrack import events
+from paytrack.events import EventLog, EVENT_LOG
+from paytrack.group import Group, Payment
+from paytrack.io import GroupsIO
+
+
+def _emit(args):
+    root, n = args
+    os.chdir(root)
+    log = EventLog('events.log', fsync=False, index_interval=7)
+    for _ in range(n):
+        log.emit(events.PERSON_ADDED, str(os.getpid()))
+
+
+def _add_payments(args):
+    root, group_id, n = args
+    os.chdir(root)
+    group = Group.from_id(group_id)
+    for _ in range(n):
+        GroupsIO.add_payment(group_id, Payment(group.people[0], group, 10))
+
+
+def test_emit_and_read(tree):
+    log = EventLog('events.log', fsync=False, index_interval=2)
+    log.emit_many([(events.PERSON_ADDED, 'p{}'.format(i), {'i': i}) for i in range(5)])
+
+    assert [e.seq for e in log.read()] == [1, 2, 3, 4, 5]
+    assert [e.payload['i'] for e in log.read(4)] == [3, 4]
+
+
+def test_torn_tail_is_repaired(tree):
+    log = EventLog('events.log', fsync=False)
+    log.emit(events.PERSON_ADDED, 'p1')
+    log.emit(events.PERSON_ADDED, 'p2')
+
+    # a writer crashed in the middle of the third event
+    with open('events.log', 'ab') as f:
+        f.write(b'{"seq": 3, "type": "person_ad')
+
+    event = log.emit(events.PERSON_ADDED, 'p3')
+
+    assert event.seq == 3
+    assert [(e.seq, e.entity_id) for e in log.read()] == [(1, 'p1'), (2, 'p2'), (3, 'p3')]
+
+
+def test_torn_first_event_is_repaired(tree):
+    log = EventLog('events.log', fsync=False)
+    with open('events.log', 'wb') as f:
+        f.write(b'{"seq": 1, "ty')
+
+    assert log.emit(events.PERSON_ADDED, 'p1').seq == 1
+    assert len(log.read()) == 1
+
+
+def test_unknown_event_type(tree):
+    log = EventLog('events.log', fsync=False)
+    with pytest.raises(ValueError):
+        log.emit('something', 'p1')
+
+    assert not os.path.exists('events.log')
+
+
+def test_concurrent_writers_get_consecutive_numbers(tree):
+    with multiprocessing.get_context('fork').Pool(4) as pool:
+        pool.map(_emit, [(tree, 50)] * 4)
+
+    log = EventLog('events.log')
+    assert [e.seq for e in log.read()] == list(range(1, 201))
+    assert [e.seq for e in log.read(101)] == list(range(101, 201))
+
+
+def test_ledger_events_follow_the_versions(tree):
+    group = Group.create_with_members([{'name': 'A'}, {'name': 'B'}], name='G')
+
+    with multiprocessing.get_context('fork').Pool(4) as pool:
+        pool.map(_add_payments, [(tree, group.id, 10)] * 4)
+
+    versions = [e.payload['ledger_version'] for e in EVENT_LOG.read() if e.type == events.PAYMENT_ADDED]
+    assert versions == list(range(1, 41))
@@ -0,0 +1,74 @@
+import os
+import pandas as pd
+import pytest
+import paytrack.io
+from paytrack.io import LayoutIO, GroupsIO, ArchiveIO
+from paytrack.group import Group, Payment
+from paytrack.DEFAULTS import *
+
+ID = 'abcdef01-2345-6789-abcd-ef0123456789'
+
+
+def _write(f_name, members):
+    os.makedirs(os.path.dirname(f_name), exist_ok=True)
+    pd.DataFrame({'members': members}).to_csv(f_name, index=False)
+
+
+def test_flat_files_are_found_and_migrated(tree):
+    flat = LayoutIO._path(GROUPS_FOLDER, ID, 0)
+    _write(flat, ['a'])
+
+    assert LayoutIO.read_path(GROUPS_FOLDER, ID) == flat
+    assert GroupsIO._load_member_list(ID) == ['a']
+
+    assert LayoutIO.migrate(GROUPS_FOLDER) == 1
+    assert not os.path.exists(flat)
+    assert LayoutIO.read_path(GROUPS_FOLDER, ID) == os.path.join(GROUPS_FOLDER, 'ab', 'cd', ID + '.csv')
+    assert GroupsIO._load_member_list(ID) == ['a']
+    assert LayoutIO.migrate(GROUPS_FOLDER) == 0
+
+
+def test_migrate_never_overwrites_a_newer_file(tree):
+    _write(LayoutIO._path(GROUPS_FOLDER, ID, 0), ['old'])
+    _write(LayoutIO.write_path(GROUPS_FOLDER, ID), ['new'])
+
+    assert LayoutIO.migrate(GROUPS_FOLDER) == 0
+    assert GroupsIO._load_member_list(ID) == ['new']
+    assert not os.path.exists(LayoutIO._path(GROUPS_FOLDER, ID, 0))
+
+
+def test_remove_in_every_layout(tree):
+    _write(LayoutIO._path(GROUPS_FOLDER, ID, 0), ['a'])
+    _write(LayoutIO._path(GROUPS_FOLDER, ID, 3), ['a'])
+
+    LayoutIO.remove(GROUPS_FOLDER, ID)
+
+    assert not os.path.exists(LayoutIO.read_path(GROUPS_FOLDER, ID))
+    with pytest.raises(FileNotFoundError):
+        LayoutIO.remove(GROUPS_FOLDER, ID)
+
+
+def test_changing_the_fan_out(tree, monkeypatch):
+    group = Group.create_with_members([{'name': 'A'}, {'name': 'B'}], name='G')
+    archived = Group.create_with_members([{'name': 'C'}, {'name': 'D'}], name='H')
+    for g in [group, archived]:
+        GroupsIO.add_payment(g.id, Payment(g.people[0], g, 10))
+    ArchiveIO.archive(archived.id)
+
+    monkeypatch.setattr(paytrack.io, 'SHARD_LEVELS', 1)
+
+    # the files of the previous layout are still there
+    assert len(GroupsIO.get_payments(group.id)) == 1
+    assert GroupsIO.get_ledger_version(group.id) == 1
+    assert ArchiveIO.is_archived(archived.id)
+    assert len(GroupsIO.get_payments(archived.id)) == 1
+
+    for folder in [PERSONS_FOLDER, GROUPS_FOLDER, PAYMENTS_FOLDER, LEDGER_VERSIONS_FOLDER, ARCHIVE_FOLDER]:
+        LayoutIO.migrate(folder)
+
+    assert ArchiveIO._path(archived.id) == os.path.join(ARCHIVE_FOLDER, archived.id[:2], archived.id + '.zip')
+    assert LayoutIO.read_path(PAYMENTS_FOLDER, group.id) == LayoutIO.write_path(PAYMENTS_FOLDER, group.id)
+
+    GroupsIO.add_payment(group.id, Payment(group.people[0], group, 10))
+    assert len(GroupsIO.get_payments(group.id)) == 2
+    assert len(GroupsIO.get_payments(archived.id)) == 1
@@ -0,0 +1,111 @@
+import uuid
+import numpy as np
+import pandas as pd
+import pytest
+from paytrack.aux import Money
+from paytrack.io import LayoutIO, GroupsIO
+from paytrack.DEFAULTS import *
+
+
+def test_split_remainder_goes_to_largest_fractions():
+    # 10 * [3, 3, 1] / 7 = [4.29, 4.29, 1.43]: one unit left, it goes to the last participant
+    owed = Money.split([10, 11], [[3, 3, 1], [3, 3, 1]])
+
+    assert owed.tolist() == [[4, 4, 2], [5, 5, 1]]
+    assert owed.dtype == np.int64
+
+
+def test_split_ties_go_to_first_column():
+    owed = Money.split([100, 2], [[1, 1, 1], [1, 1, 1]])
+
+    assert owed.tolist() == [[34, 33, 33], [1, 1, 0]]
+
+
+def test_split_never_gives_units_to_zero_weights():
+    owed = Money.split([1, 1], [[0, 1, 1], [1, 0, 1]])
+
+    assert owed.tolist() == [[0, 1, 0], [1, 0, 0]]
+
+
+def test_split_rows_sum_to_amounts():
+    rng = np.random.default_rng(0)
+    amounts = rng.integers(-10 ** 6, 10 ** 6, size=200)
+    weights = rng.integers(0, 5, size=(200, 7))
+    weights[:, 0] += 1
+
+    assert (Money.split(amounts, weights).sum(axis=1) == amounts).all()
+
+
+def test_split_negative_amount():
+    # a refund is split like a payment, with the extra units going the same way
+    owed = Money.split([-100], [[1, 1, 1]])
+
+    assert owed.tolist() == [[-33, -33, -34]]
+
+
+def test_split_without_participants():
+    with pytest.raises(ValueError):
+        Money.split([100], [[0, 0]])
+
+
+def test_to_minor_rounds_half_even():
+    assert Money.to_minor(2.675, 'EUR') == 268
+    assert Money.to_minor('0.125', 'EUR') == 12
+    assert Money.to_minor('-12.345', 'EUR') == -1234
+    assert Money.to_minor('-0.005', 'EUR') == 0
+
+
+def test_to_minor_strict():
+    assert Money.to_minor('-12.34', 'EUR', strict=True) == -1234
+
+    with pytest.raises(ValueError):
+        Money.to_minor('-12.345', 'EUR', strict=True)
+    with pytest.raises(ValueError):
+        Money.to_minor('twelve', 'EUR')
+
+
+def _write_legacy_table(amounts):
+    """Writes a payment table in the format before minor units and splits (float amounts, boolean members)"""
+
+    group_id = str(uuid.uuid4())
+    pd.DataFrame({'by': 'a', 'amount': amounts, 'currency': 'EUR', 'purpose': 'dinner', 'location': 'home',
+                  'a': True, 'b': [i % 2 == 0 for i in range(len(amounts))]}) \
+        .to_csv(LayoutIO.write_path(PAYMENTS_FOLDER, group_id), index=False)
+    return group_id
+
+
+def test_load_legacy_amounts(tree):
+    group_id = _write_legacy_table(['12.5', '0.1', '3'])
+    payment_table = GroupsIO._load_payment_table(group_id)
+
+    assert list(payment_table.columns) == PAYMENT_TABLE_COLUMNS + ['a', 'b']
+    assert payment_table.loc[:, 'amount_minor'].tolist() == [1250, 10, 300]
+    assert payment_table.loc[:, 'split'].tolist() == ['equal'] * 3
+
+
+def test_migrate_legacy_amounts(tree):
+    group_id = _write_legacy_table(['12.5', '0.1'])
+
+    assert GroupsIO.migrate_payment_table(group_id)
+    assert not GroupsIO.migrate_payment_table(group_id)
+
+    payment_table = pd.read_csv(LayoutIO.write_path(PAYMENTS_FOLDER, group_id))
+    assert 'amount' not in payment_table.columns
+    assert payment_table.loc[:, 'amount_minor'].tolist() == [1250, 10]
+
+
+def test_lossy_legacy_amounts(tree):
+    group_id = _write_legacy_table(['12.5', '0.125'])
+    f_name = LayoutIO.write_path(PAYMENTS_FOLDER, group_id)
+    with open(f_name) as f:
+        before = f.read()
+
+    # reading rounds, anything that writes the table back refuses
+    assert GroupsIO._load_payment_table(group_id).loc[:, 'amount_minor'].tolist() == [1250, 12]
+    with pytest.raises(ValueError):
+        GroupsIO._load_payment_table(group_id, strict=True)
+    with pytest.raises(ValueError):
+        GroupsIO.migrate_payment_table(group_id)
+
+    with open(f_name) as f:
+        assert f.read() == before
@@ -0,0 +1,89 @@
+import uuid
+import numpy as np
+import pandas as pd
+import pytest
+from paytrack.aux import Split
+from paytrack.group import Group, Person, Payment
+from paytrack.io import LayoutIO, GroupsIO
+from paytrack.payments import Ledger
+from paytrack.DEFAULTS import *
+
+
+def test_to_weights():
+    assert Split.to_weights('equal', 100, 'EUR', {'a': True, 'b': False}) == {'a': 1, 'b': 0}
+    assert Split.to_weights('shares', 100, 'EUR', {'a': 2, 'b': 1.0}) == {'a': 2, 'b': 1}
+    assert Split.to_weights('percent', 100, 'EUR', {'a': 62.5, 'b': '37.5'}) == {'a': 6250, 'b': 3750}
+    assert Split.to_weights('exact', 1000, 'EUR', {'a': 7.5, 'b': 2.5}) == {'a': 750, 'b': 250}
+    assert Split.to_weights('exact', -1000, 'EUR', {'a': -7.5, 'b': -2.5}) == {'a': -750, 'b': -250}
+
+
+@pytest.mark.parametrize('split, amount_minor, weights', [
+    ('shares', 100, {'a': 1.5, 'b': 1}),
+    ('percent', 100, {'a': 50, 'b': 49.99}),
+    ('percent', 100, {'a': 50.001, 'b': 49.999}),
+    ('exact', 1000, {'a': 7.5, 'b': 2.49}),
+    ('exact', 1000, {'a': 7.5, 'b': 2.495}),
+    ('shares', 100, {'a': 2, 'b': -1}),
+    ('percent', 100, {'a': 150, 'b': -50}),
+    ('exact', 1000, {'a': 15, 'b': -5}),
+    ('exact', -1000, {'a': -15, 'b': 5}),
+    ('shares', 100, {'a': 0, 'b': 0}),
+    ('equal', 100, {'a': False}),
+    ('unknown', 100, {'a': 1}),
+])
+def test_to_weights_rejects(split, amount_minor, weights):
+    with pytest.raises(ValueError):
+        Split.to_weights(split, amount_minor, 'EUR', weights)
+
+
+def test_from_weights_round_trip():
+    for split, weights in [('shares', {'a': 2, 'b': 1}), ('percent', {'a': 62.5, 'b': 37.5}),
+                           ('exact', {'a': 7.5, 'b': 2.5})]:
+        stored = Split.to_weights(split, 1000, 'EUR', weights)
+        assert Split.from_weights(split, 'EUR', stored) == weights
+
+
+def test_owed_keeps_exact_amounts():
+    owed = Split.owed([1000, 1000], np.array(['exact', 'shares']), [[750, 250], [3, 1]])
+
+    assert owed.tolist() == [[750, 250], [750, 250]]
+
+
+def test_legacy_boolean_members_are_equal_weights(tree):
+    group_id = str(uuid.uuid4())
+    pd.DataFrame({'by': ['a', 'b'], 'amount_minor': [300, 100], 'currency': 'EUR', 'purpose': 'dinner',
+                  'location': 'home', 'a': [True, False], 'b': [True, True], 'c': [False, True]}) \
+        .to_csv(LayoutIO.write_path(PAYMENTS_FOLDER, group_id), index=False)
+
+    payment_table = GroupsIO._load_payment_table(group_id)
+
+    assert payment_table.loc[:, 'split'].tolist() == ['equal', 'equal']
+    assert payment_table.loc[:, ['a', 'b', 'c']].dtypes.tolist() == [np.int64] * 3
+
+    owed = Split.owed(payment_table.loc[:, 'amount_minor'], payment_table.loc[:, 'split'],
+                      payment_table.loc[:, ['a', 'b', 'c']])
+    assert owed.tolist() == [[150, 150, 0], [0, 50, 50]]
+
+
+def test_payment_rejects_outsiders(tree):
+    group = Group.create_with_members([{'name': 'A'}, {'name': 'B'}], name='G')
+    a, _ = group.people
+    outsider = Person(name='O')
+
+    with pytest.raises(ValueError):
+        Payment(a, group, 10, split='exact', weights={a: 5, outsider: 5})
+    with pytest.raises(ValueError):
+        Payment(outsider, group, 10)
+
+    # built without the group object, the saved members are checked
+    with pytest.raises(ValueError):
+        GroupsIO.add_payment(group.id, Payment(outsider.id, group.id, 10, people=[a.id]))
+
+
+def test_balances_keep_payers_without_a_column():
+    payment_table = pd.DataFrame({'by': ['x'], 'amount_minor': [1000], 'currency': 'EUR', 'purpose': 'dinner',
+                                  'location': 'home', 'split': 'equal', 'a': [1], 'b': [1]})
+
+    balances = Ledger.compute_balances(payment_table)
+
+    assert balances.loc[:, 'EUR'].to_dict() == {'a': -500, 'b': -500, 'x': 1000}